@@ -0,0 +1,64 @@
+"""
+Synthetic data shared by the benchmarks, so they run without any TMC workbooks.
+"""
+import time
+import tracemalloc
+from datetime import time as dt_time
+
+import numpy as np
+import pandas as pd
+
+# Every leg has every movement, which is the widest a TMC file gets
+MODES = ["light", "heavy", "bikes"]
+LEGS = ["nb", "sb", "eb", "wb"]
+MOVEMENTS = ["u", "left", "thru", "right"]
+
+
+def count_columns() -> list:
+    """ Column names like generate_timeseries_data() returns, i.e. 'light_sb_left' """
+    columns = [f"{mode}_{leg}_{movement}" for mode in MODES for leg in LEGS for movement in MOVEMENTS]
+    return columns + [f"peds_{leg}_xwalk" for leg in LEGS]
+
+
+def timeseries_frame(num_locations: int,
+                     rows_per_location: int = 60,
+                     first_hour: int = 5,
+                     seed: int = 0) -> pd.DataFrame:
+    """
+    A frame shaped like Project.generate_timeseries_data(): a time index,
+    a location column and one column of counts per movement.
+
+    The rows are 15-minute bins from first_hour, so the default is 5:00 to 20:00
+    and 96 rows from hour 0 is a whole day. About 40% of the counts are zero.
+    """
+
+    rng = np.random.default_rng(seed)
+    times = [dt_time(first_hour + i // 4, 15 * (i % 4)) for i in range(rows_per_location)]
+    columns = count_columns()
+
+    index = pd.Index(times * num_locations, name="time")
+    shape = (len(index), len(columns))
+    counts = rng.integers(1, 20, size=shape) * (rng.random(shape) > 0.4)
+
+    df = pd.DataFrame(counts, index=index, columns=columns)
+    df.insert(0, "location", np.repeat([f"Location {i}" for i in range(num_locations)], rows_per_location))
+
+    return df
+
+
+def measure(func, *args, repeat: int = 3) -> tuple:
+    """ (best seconds, peak traced bytes, result) for func(*args) """
+
+    seconds = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func(*args)
+        seconds.append(time.perf_counter() - started)
+
+    # tracemalloc slows everything down, so the memory is measured on its own run
+    tracemalloc.start()
+    result = func(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return min(seconds), peak, result
@@ -0,0 +1,71 @@
+"""
+How many bytes the Data Explorer's figures take, and how long they take to serialize.
+
+Each figure is sent as plain JSON lists and as binary_figure()'s base64 typed
+arrays, before and after gzip (flask-compress gzips every response).
+
+    (tmc_env) $ python -m benchmarks.figure_payload
+    (tmc_env) $ python -m benchmarks.figure_payload --locations 10 50 100 200
+"""
+import argparse
+import gzip
+import json
+import time
+
+import plotly
+
+from benchmarks.common import timeseries_frame
+from tmc_app.data_viz.dash_app import timeseries_figure, treemap_figure
+from tmc_app.data_viz.get_data import aggregate_treemap_data, binary_figure, generate_treemap_data
+
+
+def serialize(fig, binary: bool, repeat: int) -> tuple:
+    """ (best seconds, JSON bytes) for one way of sending fig """
+
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        payload = binary_figure(fig) if binary else fig
+        body = json.dumps(payload, cls=plotly.utils.PlotlyJSONEncoder).encode()
+        seconds = time.perf_counter() - started
+        best = seconds if best is None else min(best, seconds)
+
+    return best, body
+
+
+def report(name: str, fig, repeat: int):
+    cells = []
+    for binary in (False, True):
+        seconds, body = serialize(fig, binary, repeat)
+        cells.append(f"{len(body) / 1024:>8.0f} KB {len(gzip.compress(body)) / 1024:>6.0f} KB {seconds * 1000:>6.1f} ms")
+
+    print(f"{name:<22} | {cells[0]} | {cells[1]}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--locations", type=int, nargs="+", default=[10, 50, 100])
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per figure, the best is reported")
+    args = parser.parse_args()
+
+    print(f"{'figure':<22} | {'plain JSON':>8} {'gzip':>9} {'time':>9} | {'typed arrays':>8} {'gzip':>7} {'time':>9}")
+
+    for num_locations in args.locations:
+        df = timeseries_frame(num_locations)
+
+        # Tight rows, since the default spacing doesn't fit that many facets
+        kwargs = {"facet_col": "location", "facet_col_wrap": 3, "facet_row_spacing": 0.002}
+        fig = timeseries_figure(df, plot_kwargs=kwargs)
+        report(f"timeseries, {num_locations} loc", fig, args.repeat)
+
+        path = ["location", "leg", "movement"]
+        df_treemap = aggregate_treemap_data(generate_treemap_data(df), path)
+        fig = treemap_figure(df_treemap, plot_kwargs={"values": "total", "path": path})
+        report(f"treemap, {num_locations} loc", fig, args.repeat)
+
+    print("\nSizes are the response body before and after gzip. "
+          "Time is building the payload plus json.dumps().")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+How long the web app and the worker take to boot, from python -X importtime.
+
+Each target is imported in a fresh interpreter against an empty SQLite
+database, like a uWSGI worker or worker.py starting up. The report has the
+wall clock time, the slowest imports, and whether pandas, plotly or Dash
+were loaded at all.
+
+    (tmc_env) $ python benchmarks/import_time.py
+    (tmc_env) $ python benchmarks/import_time.py --repeat 5 --top 15
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+REPO = Path(__file__).resolve().parent.parent
+
+# What each process imports when it starts, see wsgi.py and worker.py
+TARGETS = {
+    "wsgi": "import wsgi",
+    "worker": "import worker",
+}
+
+# Packages that should only load once they're needed
+HEAVY_PACKAGES = ["pandas", "pyarrow", "plotly", "dash", "xlsxwriter"]
+
+
+def parse_importtime(stderr: str) -> dict:
+    """ {module: cumulative microseconds} from python -X importtime output """
+
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+
+        _, cumulative, name = line[len("import time:"):].split("|")
+        modules[name.strip()] = int(cumulative)
+
+    return modules
+
+
+def run_target(statement: str, folder: str) -> tuple:
+    """ Import statement in a new interpreter, returning (seconds, modules) """
+
+    env = dict(os.environ)
+    env.update({
+        "SQLALCHEMY_DATABASE_URI": f"sqlite:///{folder}/import_time.db",
+        "RAW_DATA_FOLDER": f"{folder}/raw",
+        "SUMMARY_FILE_FOLDER": f"{folder}/summaries",
+        "CACHE_DIR": f"{folder}/cache",
+        "PYTHONPATH": str(REPO),
+    })
+
+    started = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        cwd=REPO,
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    seconds = time.perf_counter() - started
+
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+
+    return seconds, parse_importtime(result.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=3, help="boots per target, the median is reported")
+    parser.add_argument("--top", type=int, default=10, help="how many of the slowest imports to list")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        for name, statement in TARGETS.items():
+            try:
+                runs = [run_target(statement, folder) for _ in range(args.repeat)]
+            except RuntimeError as e:
+                print(f"{name}: failed to boot, {e}\n")
+                continue
+
+            seconds = statistics.median(run[0] for run in runs)
+            modules = runs[-1][1]
+
+            print(f"{name}: {seconds:.2f}s to boot (median of {args.repeat}), {len(modules)} modules")
+
+            loaded = [pkg for pkg in HEAVY_PACKAGES if pkg in modules]
+            print(f"  heavy packages loaded: {', '.join(loaded) if loaded else 'none'}")
+
+            # Only top-level packages, so a package and its submodules aren't listed twice
+            top_level = {mod: us for mod, us in modules.items() if "." not in mod}
+            for mod, us in sorted(top_level.items(), key=lambda item: -item[1])[:args.top]:
+                print(f"  {us / 1e6:6.3f}s  {mod}")
+            print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+normalize_time_column() against the iterrows() loop it replaced in SQLUpload.read_data().
+
+The sheets are 20 count columns plus a time column of mixed cells, half
+datetime.time objects and half 'H:MM' strings, at 96 rows (a day of 15-minute
+bins) and 2000 rows. Both versions are checked to give the same times.
+
+    (tmc_env) $ python -m benchmarks.time_column
+    (tmc_env) $ python -m benchmarks.time_column --rows 96 2000 10000
+"""
+import argparse
+from datetime import time
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.common import measure
+from tmc_app.models.upload_model import normalize_time_column
+
+
+def mixed_sheet(num_rows: int, num_columns: int = 20) -> pd.DataFrame:
+    """ A parsed tab, before its time column is cleaned up """
+
+    minutes = [(15 * i) % (24 * 60) for i in range(num_rows)]
+    times = [
+        time(m // 60, m % 60) if i % 2 else f"{m // 60}:{m % 60:02d}"
+        for i, m in enumerate(minutes)
+    ]
+
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame(rng.integers(0, 20, size=(num_rows, num_columns)),
+                      columns=[f"c{i}" for i in range(num_columns)])
+    df.insert(0, "time", pd.Series(times, dtype=object))
+
+    return df
+
+
+def loop_times(df: pd.DataFrame) -> pd.DataFrame:
+    """ The previous version, one row at a time """
+
+    df = df.copy()
+    for idx, row in df.iterrows():
+        if type(row.time) != time:
+            hour, minute = row.time.split(":")
+            df.at[idx, "time"] = time(hour=int(hour), minute=int(minute))
+
+    return df
+
+
+def vectorized_times(df: pd.DataFrame) -> pd.DataFrame:
+    df = df.copy()
+    df["time"] = normalize_time_column(df["time"], "benchmark")
+
+    return df
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, nargs="+", default=[96, 2000])
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs per case, the best is reported")
+    args = parser.parse_args()
+
+    print(f"{'rows':>6} | {'loop':>9} | {'vectorized':>10} | speedup")
+
+    for num_rows in args.rows:
+        df = mixed_sheet(num_rows)
+
+        loop_seconds, _, loop_result = measure(loop_times, df, repeat=args.repeat)
+        vector_seconds, _, vector_result = measure(vectorized_times, df, repeat=args.repeat)
+
+        if list(loop_result["time"]) != list(vector_result["time"]):
+            raise AssertionError(f"The two versions disagree at {num_rows} rows")
+
+        print(f"{num_rows:>6} | {loop_seconds * 1000:>6.1f} ms | {vector_seconds * 1000:>7.1f} ms | "
+              f"{loop_seconds / vector_seconds:>6.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Time and peak memory of generate_treemap_data() at 10, 100 and 500 locations.
+
+It's compared with the stack()-based version it replaced, which is kept
+below as stacked_treemap_data(), and the two are checked to give the same rows.
+
+    (tmc_env) $ python -m benchmarks.treemap_data
+    (tmc_env) $ python -m benchmarks.treemap_data --locations 10 100 500 1000
+"""
+import argparse
+
+import pandas as pd
+
+from benchmarks.common import measure, timeseries_frame
+from tmc_app.data_viz.get_data import aggregate_treemap_data, generate_treemap_data
+
+
+def stacked_treemap_data(df_timeseries, id_col: str = "location"):
+    """ The previous generate_treemap_data(), which split every column name once per row """
+
+    df_timeseries = df_timeseries.set_index([df_timeseries[id_col], df_timeseries.index]).drop(columns=[id_col])
+
+    df_stacked = pd.DataFrame(df_timeseries.stack(), columns=["total"]).reset_index()
+    df_filtered = df_stacked[df_stacked.total != 0]
+
+    df_attrs = df_filtered["level_2"].str.split("_", expand=True).rename(
+        columns={0: "veh_class", 1: "leg", 2: "movement"}
+    )
+    df = pd.concat([df_filtered, df_attrs], axis=1, sort=False)
+
+    df["hour"] = [str(t.hour) for t in df["time"]]
+    df["minute"] = [f":{t.minute:02d}" for t in df["time"]]
+
+    return df.drop(columns=["level_2", "time"])
+
+
+def same_rows(df_old, df_new) -> bool:
+    columns = list(df_new.columns)
+    old = df_old[columns].reset_index(drop=True).astype(str)
+    return old.equals(df_new.astype(str))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--locations", type=int, nargs="+", default=[10, 100, 500])
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per case, the best is reported")
+    args = parser.parse_args()
+
+    print(f"{'locations':>9} {'rows':>8} | {'stacked':>17} {'result':>8} | {'vectorized':>17} {'result':>8} | {'aggregate':>9}")
+
+    for num_locations in args.locations:
+        df = timeseries_frame(num_locations)
+
+        old_seconds, old_peak, old_result = measure(stacked_treemap_data, df, repeat=args.repeat)
+        new_seconds, new_peak, new_result = measure(generate_treemap_data, df, repeat=args.repeat)
+        agg_seconds, _, _ = measure(aggregate_treemap_data, new_result, ["location", "leg"], repeat=args.repeat)
+
+        if not same_rows(old_result, new_result):
+            raise AssertionError(f"The two versions disagree at {num_locations} locations")
+
+        old_mb = old_result.memory_usage(deep=True).sum() / 2**20
+        new_mb = new_result.memory_usage(deep=True).sum() / 2**20
+
+        print(
+            f"{num_locations:>9} {len(new_result):>8} | "
+            f"{old_seconds * 1000:>7.1f} ms {old_peak / 2**20:>6.1f} MB {old_mb:>5.1f} MB | "
+            f"{new_seconds * 1000:>7.1f} ms {new_peak / 2**20:>6.1f} MB {new_mb:>5.1f} MB | "
+            f"{agg_seconds * 1000:>6.1f} ms"
+        )
+
+    print("\nstacked/vectorized: best time, peak traced memory, size of the result. "
+          "aggregate: aggregate_treemap_data() down to location > leg.")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,5 @@
 """Flask app configuration."""
-from os import environ, path
+from os import environ, path, cpu_count
 from dotenv import load_dotenv
 
 basedir = path.abspath(path.dirname(__file__))
@@ -29,6 +29,52 @@ class Config:
     SQLALCHEMY_ECHO = False
     SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+    # Connection pool, shared by Flask-SQLAlchemy and tmc_app.models.engines
+    # Keep processes * (DB_POOL_SIZE + DB_MAX_OVERFLOW) below Postgres' max_connections
+    DB_POOL_SIZE = int(environ.get('DB_POOL_SIZE', 5))
+    DB_MAX_OVERFLOW = int(environ.get('DB_MAX_OVERFLOW', 5))
+    DB_POOL_RECYCLE = int(environ.get('DB_POOL_RECYCLE', 1800))
+    DB_POOL_TIMEOUT = int(environ.get('DB_POOL_TIMEOUT', 30))
+
+    # 'copy' streams new rows through Postgres' COPY FROM STDIN, 'insert' uses
+    # plain INSERTs. Other databases (i.e. SQLite) always use INSERTs
+    BULK_INSERT_METHOD = environ.get('BULK_INSERT_METHOD', 'copy')
+
+    # How counts are stored:
+    #   - 'wide': one table per file plus data_merged_p{pid}, a column per movement
+    #   - 'long': one row per count in the countdata table
+    # Switching backends only applies to files imported afterwards
+    STORAGE_BACKEND = environ.get('STORAGE_BACKEND', 'wide')
+
+    # Server-side cache for the Data Explorer, see tmc_app/cache.py
+    # It's a SQLite file so that every uWSGI process shares it
+    CACHE_DIR = environ.get('CACHE_DIR', path.join(basedir, 'cache'))
+    # Total size of the pickled values, in bytes
+    CACHE_MAX_BYTES = int(environ.get('CACHE_MAX_BYTES', 256 * 1024 * 1024))
+    CACHE_DEFAULT_TIMEOUT = int(environ.get('CACHE_DEFAULT_TIMEOUT', 60 * 60 * 24))
+
+    # Send each project's timeseries to the browser once, and filter the Data Explorer's
+    # time range and modes there instead of asking the server after every change
+    DATA_EXPLORER_CLIENTSIDE = environ.get('DATA_EXPLORER_CLIENTSIDE', 'false').lower() == 'true'
+
+    # Most bars the project page's overview chart draws at 15-minute
+    # resolution. Bigger projects are shown as hourly totals instead
+    OVERVIEW_MAX_POINTS = int(environ.get('OVERVIEW_MAX_POINTS', 5000))
+
+    # Size of each piece the project page sends to the chunked upload endpoint
+    UPLOAD_CHUNK_SIZE = int(environ.get('UPLOAD_CHUNK_SIZE', 8 * 1024 * 1024))
+
     # Google Maps API key
     GMAPS_API_KEY = environ.get("GMAPS_API_KEY")
     SUMMARY_FILE_FOLDER = environ.get("SUMMARY_FILE_FOLDER")
+
+    # Background imports, see tmc_app/jobs.py
+    # Excel files are parsed on INGEST_PROCESSES processes and written to
+    # the database over at most INGEST_DB_CONNECTIONS connections
+    INGEST_PROCESSES = int(environ.get('INGEST_PROCESSES', cpu_count() or 1))
+    INGEST_DB_CONNECTIONS = int(environ.get('INGEST_DB_CONNECTIONS', 2))
+    INGEST_BATCH_SIZE = int(environ.get('INGEST_BATCH_SIZE', 50))
+
+    # Running jobs that haven't made progress for this long are assumed to
+    # belong to a worker that crashed, and are put back in the queue
+    JOB_TIMEOUT_MINUTES = int(environ.get('JOB_TIMEOUT_MINUTES', 30))
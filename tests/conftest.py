@@ -0,0 +1,42 @@
+"""
+A SQLite app for the tests, in a temporary folder.
+
+    (tmc_env) $ python -m pytest tests
+"""
+import os
+import tempfile
+
+# config.py and the models read these when they're imported
+_tmp = tempfile.mkdtemp(prefix="tmc_tests_")
+os.environ["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{_tmp}/tmc.db"
+os.environ["RAW_DATA_FOLDER"] = f"{_tmp}/raw"
+os.environ["SUMMARY_FILE_FOLDER"] = f"{_tmp}/summaries"
+os.environ["CACHE_DIR"] = f"{_tmp}/cache"
+os.environ.setdefault("SECRET_KEY", "tests")
+
+import pytest
+
+from tmc_app import create_app, db
+from tmc_app.models import User
+
+
+@pytest.fixture(scope="session")
+def app():
+    app = create_app(with_dashboard=False)
+
+    with app.app_context():
+        user = User(name="Test User", email="test@dvrpc.org", password="password")
+        db.session.add(user)
+        db.session.commit()
+
+    return app
+
+
+@pytest.fixture
+def client(app):
+    """ A test client, logged in as the test user """
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session["_user_id"] = "1"
+        session["_fresh"] = True
+    return client
@@ -0,0 +1,47 @@
+"""
+The web app boots without Dash and plotly, and builds the Data Explorer when it's opened.
+"""
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+from flask import Flask
+
+from tmc_app import LazyDataExplorer
+
+
+def test_web_app_boots_without_dash():
+    statement = (
+        "import sys\n"
+        "from tmc_app import create_app\n"
+        "create_app()\n"
+        "print(sorted(pkg for pkg in ('dash', 'plotly') if pkg in sys.modules))"
+    )
+    env = dict(os.environ, PYTHONPATH=str(Path(__file__).resolve().parent.parent))
+
+    result = subprocess.run([sys.executable, "-c", statement], env=env, capture_output=True, text=True)
+
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip().splitlines()[-1] == "[]"
+
+
+def test_data_explorer_is_built_on_its_first_request(app, monkeypatch):
+    built = []
+
+    def create_server(self):
+        server = Flask("dashboard")
+        server.add_url_rule("/data-explorer/", "explorer", lambda: "explorer")
+        built.append(server)
+        return server
+
+    monkeypatch.setattr(LazyDataExplorer, "create_server", create_server)
+    monkeypatch.setattr(app, "wsgi_app", LazyDataExplorer(app))
+    client = app.test_client()
+
+    assert client.get("/").status_code == 200
+    assert built == []
+
+    assert client.get("/data-explorer/").data == b"explorer"
+    assert client.get("/data-explorer/").data == b"explorer"
+    assert len(built) == 1
@@ -0,0 +1,54 @@
+"""
+The SQLite cache is bounded by the size of what it holds, not the number of entries.
+"""
+import itertools
+import sqlite3
+
+import pytest
+
+from tmc_app import cache
+from tmc_app.cache import SQLiteLRUCache
+
+
+@pytest.fixture(autouse=True)
+def clock(monkeypatch):
+    """ A clock that ticks once per call, so every entry has its own last_used """
+    ticks = itertools.count(1000)
+    monkeypatch.setattr(cache.time, "time", lambda: next(ticks))
+
+
+def test_least_recently_used_entries_are_evicted_by_size(tmp_path):
+    lru = SQLiteLRUCache(tmp_path / "cache.sqlite", max_bytes=2500)
+
+    lru.set("a", b"a" * 1000)
+    lru.set("b", b"b" * 1000)
+    assert lru.get("a") is not None
+
+    # "b" is now the least recently used, and all three don't fit
+    lru.set("c", b"c" * 1000)
+
+    assert lru.get("b") is None
+    assert lru.get("a") == b"a" * 1000
+    assert lru.get("c") == b"c" * 1000
+
+
+def test_values_bigger_than_the_cache_are_not_stored(tmp_path):
+    lru = SQLiteLRUCache(tmp_path / "cache.sqlite", max_bytes=2500)
+    lru.set("a", b"a" * 1000)
+
+    lru.set("huge", b"h" * 5000)
+
+    assert lru.get("huge") is None
+    assert lru.get("a") == b"a" * 1000
+
+
+def test_caches_without_sizes_are_rebuilt(tmp_path):
+    path = tmp_path / "cache.sqlite"
+    with sqlite3.connect(str(path)) as conn:
+        conn.execute("CREATE TABLE entries (key TEXT PRIMARY KEY, value BLOB NOT NULL, "
+                     "expires REAL NOT NULL, last_used REAL NOT NULL)")
+
+    lru = SQLiteLRUCache(path, max_bytes=2500)
+    lru.set("a", 1)
+
+    assert lru.get("a") == 1
@@ -0,0 +1,62 @@
+"""
+Re-queueing jobs left behind by a worker that crashed.
+"""
+from datetime import timedelta
+
+import pytest
+
+from tmc_app import db
+from tmc_app.jobs import _now, _set_progress, requeue_stale_jobs
+from tmc_app.models import JOB_QUEUED, JOB_RUNNING, Job, Project
+
+
+@pytest.fixture
+def project_id(app):
+    with app.app_context():
+        project = Project(name="Stale Jobs", description="Job queue test", created_by=1)
+        db.session.add(project)
+        db.session.commit()
+        pid = project.uid
+
+    yield pid
+
+    with app.app_context():
+        Job.query.filter_by(project_id=pid).delete()
+        Project.query.filter_by(uid=pid).delete()
+        db.session.commit()
+
+
+def running_job(project_id: int, started_hours_ago: float, heartbeat_hours_ago: float = None) -> Job:
+    now = _now()
+    heartbeat_on = None if heartbeat_hours_ago is None else now - timedelta(hours=heartbeat_hours_ago)
+
+    job = Job(kind="summary", status=JOB_RUNNING, project_id=project_id, created_by=1,
+              started_on=now - timedelta(hours=started_hours_ago), heartbeat_on=heartbeat_on)
+    db.session.add(job)
+    db.session.commit()
+
+    return job
+
+
+def test_long_job_that_makes_progress_is_left_running(app, project_id):
+    with app.app_context():
+        job = running_job(project_id, started_hours_ago=2, heartbeat_hours_ago=2)
+        _set_progress(job, 40, "Still going")
+
+        assert requeue_stale_jobs(timeout_minutes=30) == 0
+        assert Job.query.get(job.uid).status == JOB_RUNNING
+
+
+def test_jobs_without_recent_progress_are_requeued(app, project_id):
+    with app.app_context():
+        stale = running_job(project_id, started_hours_ago=2, heartbeat_hours_ago=1)
+        legacy = running_job(project_id, started_hours_ago=2)
+        fresh = running_job(project_id, started_hours_ago=0)
+        stale_id, legacy_id, fresh_id = stale.uid, legacy.uid, fresh.uid
+
+        assert requeue_stale_jobs(timeout_minutes=30) == 2
+
+        assert Job.query.get(stale_id).status == JOB_QUEUED
+        assert Job.query.get(stale_id).heartbeat_on is None
+        assert Job.query.get(legacy_id).status == JOB_QUEUED
+        assert Job.query.get(fresh_id).status == JOB_RUNNING
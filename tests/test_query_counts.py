@@ -0,0 +1,96 @@
+"""
+The dashboard and project page should run the same number of SQL statements
+however many files a project has, so nothing on them queries once per file.
+"""
+from contextlib import contextmanager
+from datetime import time
+
+import pandas as pd
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from tmc_app import db
+from tmc_app.models import Project, TMCFile
+from tmc_app.models.engines import get_engine
+from tmc_app.models.upload_model import SQLUpload, merge_into_project_table, refresh_rollups
+
+
+def counts_frame(file_id: int) -> pd.DataFrame:
+    """ A small spliced light & heavy frame, like SQLUpload.read_workbook() returns """
+    times = [time(7, 15 * i) for i in range(4)]
+
+    return pd.DataFrame({
+        "light_sb_left": [3, 8, 13, 7],
+        "light_sb_thru": [5, 2, 8, 4],
+        "heavy_sb_left": [1, 0, 2, 1],
+        "fid": file_id,
+    }, index=pd.Index(times, name="time"))
+
+
+def make_project(name: str, num_files: int) -> int:
+    """ A project with num_files imported files, returning its uid """
+
+    project = Project(name=name, description="Query count test", created_by=1)
+    db.session.add(project)
+    db.session.commit()
+
+    engine = get_engine()
+
+    for i in range(num_files):
+        tmc_file = TMCFile(filename=f"file_{i}.xlsx", title=f"Location {i}", project_id=project.uid, uploaded_by=1)
+        db.session.add(tmc_file)
+        db.session.commit()
+
+        df = counts_frame(tmc_file.uid)
+        SQLUpload(project.uid, tmc_file.uid, None).publish_to_database(df=df, engine=engine)
+        merge_into_project_table(engine, project.uid, tmc_file.uid)
+        refresh_rollups(engine, project.uid, tmc_file.uid, df)
+
+    return project.uid
+
+
+@contextmanager
+def count_statements():
+    """ Count the statements sent to any database while the block runs """
+    counter = {"statements": 0}
+
+    def before_cursor_execute(*args):
+        counter["statements"] += 1
+
+    event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield counter
+    finally:
+        event.remove(Engine, "before_cursor_execute", before_cursor_execute)
+
+
+def statements_for(client, url: str) -> int:
+    with count_statements() as counter:
+        response = client.get(url)
+
+    assert response.status_code == 200
+    return counter["statements"]
+
+
+def test_project_page_statements_dont_grow_with_files(app, client):
+    with app.app_context():
+        small = make_project("Two Files", 2)
+        large = make_project("Ten Files", 10)
+
+    # Warm up anything that's only looked up once per project, i.e. the merged table's columns
+    statements_for(client, f"/project/{small}")
+    statements_for(client, f"/project/{large}")
+
+    assert statements_for(client, f"/project/{small}") == statements_for(client, f"/project/{large}")
+
+
+def test_dashboard_statements_dont_grow_with_files(app, client):
+    with app.app_context():
+        make_project("Dashboard Two Files", 2)
+
+    before = statements_for(client, "/projects")
+
+    with app.app_context():
+        make_project("Dashboard Ten Files", 10)
+
+    assert statements_for(client, "/projects") == before
@@ -0,0 +1,92 @@
+"""
+Projects whose files are stored in countdata (STORAGE_BACKEND = 'long'),
+including files that never imported.
+"""
+from datetime import time
+
+import pandas as pd
+import pytest
+
+from tmc_app import db
+from tmc_app.models import JOB_DONE, JOB_FAILED, Job, Project, TMCFile
+from tmc_app.models.engines import get_engine
+from tmc_app.models.upload_model import SQLUpload, refresh_rollups
+
+
+def counts_frame(file_id: int) -> pd.DataFrame:
+    """ A small spliced light & heavy frame, like SQLUpload.read_workbook() returns """
+    times = [time(7, 15 * i) for i in range(4)]
+
+    return pd.DataFrame({
+        "light_sb_left": [3, 8, 13, 7],
+        "heavy_sb_left": [1, 0, 2, 1],
+        "fid": file_id,
+    }, index=pd.Index(times, name="time"))
+
+
+def add_file(project, name: str, status: str) -> TMCFile:
+    """ A file whose import job ended with status, written to countdata if it's done """
+
+    tmc_file = TMCFile(filename=name, title=name, project_id=project.uid, uploaded_by=1)
+    db.session.add(tmc_file)
+    db.session.flush()
+    db.session.add(Job(kind="ingest", status=status, project_id=project.uid, file_id=tmc_file.uid, created_by=1))
+
+    # SQLite only has one writer, so finish this transaction before writing the counts
+    db.session.commit()
+
+    if status == JOB_DONE:
+        engine = get_engine()
+        df = counts_frame(tmc_file.uid)
+        SQLUpload(project.uid, tmc_file.uid, None).publish_counts(df=df, engine=engine)
+        refresh_rollups(engine, project.uid, tmc_file.uid, df)
+        tmc_file.storage_backend = "long"
+
+    db.session.commit()
+    return tmc_file
+
+
+@pytest.fixture(scope="module")
+def long_project(app):
+    app.config["STORAGE_BACKEND"] = "long"
+
+    with app.app_context():
+        project = Project(name="Long With A Failed File", description="Storage backend test", created_by=1)
+        db.session.add(project)
+        db.session.commit()
+
+        imported = add_file(project, "imported.xlsx", JOB_DONE)
+        failed = add_file(project, "failed.xlsx", JOB_FAILED)
+
+        yield project.uid, imported.uid, failed.uid
+
+    app.config["STORAGE_BACKEND"] = "wide"
+
+
+def test_failed_file_is_left_out_of_the_reads(app, long_project):
+    pid, imported, failed = long_project
+
+    with app.app_context():
+        project = Project.query.get(pid)
+
+        assert project._fids_by_backend([imported, failed]) == ([], [imported])
+        assert project.uses_count_table([imported, failed])
+
+        df = project.generate_timeseries_data(fids_to_include=[imported, failed])
+        assert list(df["location"].unique()) == ["imported.xlsx"]
+        assert df["light_sb_left"].sum() == 31
+
+        totals = project.generate_location_totals(fids_to_include=[imported, failed])
+        assert totals["total"].sum() == 35
+
+
+def test_data_explorer_only_reads_ready_files(app, long_project):
+    from tmc_app.data_viz.dash_app import timeseries_data
+
+    pid, imported, failed = long_project
+    selection = {"pid": pid, "start": "5:00", "end": "20:00", "modes": ["light", "heavy"], "fids": [imported, failed]}
+
+    with app.test_request_context():
+        df = timeseries_data(selection)
+
+    assert list(df["location"].unique()) == ["imported.xlsx"]
@@ -0,0 +1,27 @@
+"""
+The Data Explorer's treemap only has nodes for counts that were recorded.
+"""
+from datetime import time
+
+import pandas as pd
+import plotly.express as px
+
+from tmc_app.data_viz.get_data import aggregate_treemap_data, generate_treemap_data
+
+
+def test_treemap_has_no_empty_nodes():
+    # Each location only has a count for one movement
+    df_timeseries = pd.DataFrame({
+        "location": ["North", "South"],
+        "light_nb_left": [5, 0],
+        "heavy_sb_thru": [0, 2],
+    }, index=pd.Index([time(7, 0), time(7, 15)], name="time"))
+
+    path = ["location", "veh_class", "leg", "movement"]
+    df = aggregate_treemap_data(generate_treemap_data(df_timeseries), path)
+
+    fig = px.treemap(df, path=path, values="total")
+
+    # North/light/nb/left and South/heavy/sb/thru, with four nodes each
+    assert len(fig.data[0].ids) == 8
+    assert sorted(fig.data[0].ids)[-1] == "South/heavy/sb/thru"
@@ -0,0 +1,118 @@
+"""
+Zip and file uploads through the chunked upload endpoint.
+"""
+import io
+import os
+import zipfile
+
+import flask
+import pytest
+from flask_wtf.csrf import generate_csrf
+
+from tmc_app import db
+from tmc_app.models import JOB_FAILED, Project, TMCFile
+
+
+@pytest.fixture
+def project(app):
+    with app.app_context():
+        project = Project(name=f"Uploads {os.urandom(4).hex()}", description="Upload test", created_by=1)
+        db.session.add(project)
+        db.session.commit()
+        project.folder_path().mkdir(parents=True)
+
+        yield project.uid, project.folder_path()
+
+
+@pytest.fixture
+def upload(app, client):
+    """ Send a whole file to the chunked upload endpoint in one piece """
+
+    with app.test_request_context():
+        token = generate_csrf()
+        session = dict(flask.session)
+
+    with client.session_transaction() as client_session:
+        client_session.update(session)
+
+    def _upload(pid: int, filename: str, data: bytes):
+        return client.post(
+            f"/project/{pid}/upload-chunk?upload_id={os.urandom(4).hex()}"
+            f"&filename={filename}&offset=0&total={len(data)}",
+            data=data,
+            headers={"X-CSRFToken": token, "Content-Type": "application/octet-stream"},
+        )
+
+    return _upload
+
+
+def make_zip(members: dict) -> bytes:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as archive:
+        for name, data in members.items():
+            archive.writestr(name, data)
+    return buffer.getvalue()
+
+
+def saved_files(app, pid: int, folder) -> tuple:
+    """ (TMCFile names, files in the project folder) """
+    with app.app_context():
+        names = sorted(f.filename for f in TMCFile.query.filter_by(project_id=pid))
+    return names, sorted(p.name for p in folder.iterdir() if p.is_file())
+
+
+def test_same_name_in_different_folders(app, project, upload):
+    pid, folder = project
+    data = make_zip({"north/count.xlsx": b"north", "south/count.xlsx": b"south", "other.xlsx": b"other"})
+
+    response = upload(pid, "counts.zip", data)
+
+    assert response.status_code == 200
+    assert saved_files(app, pid, folder) == (["north_count.xlsx", "other.xlsx", "south_count.xlsx"],) * 2
+    assert (folder / "north_count.xlsx").read_bytes() == b"north"
+    assert (folder / "south_count.xlsx").read_bytes() == b"south"
+
+
+def test_names_that_still_clash_are_rejected(app, project, upload):
+    pid, folder = project
+    data = make_zip({"north/count.xlsx": b"north", "south/count.xlsx": b"south", "north_count.xlsx": b"again"})
+
+    response = upload(pid, "counts.zip", data)
+
+    assert response.status_code == 400
+    assert "north_count.xlsx" in response.json["error"]
+    assert saved_files(app, pid, folder) == ([], [])
+
+
+def test_corrupt_zip_is_rejected(app, project, upload):
+    pid, folder = project
+
+    response = upload(pid, "counts.zip", b"not a zip file")
+
+    assert response.status_code == 400
+    assert saved_files(app, pid, folder) == ([], [])
+
+
+def test_other_file_types_are_rejected(app, project, upload):
+    pid, folder = project
+
+    response = upload(pid, "notes.txt", b"hello")
+
+    assert response.status_code == 400
+    assert saved_files(app, pid, folder) == ([], [])
+
+
+def test_failed_file_can_be_uploaded_again_under_another_name(app, project, upload):
+    pid, folder = project
+    assert upload(pid, "Bad Name.xlsx", b"counts").json["results"] == {"new": ["Bad_Name.xlsx"]}
+
+    # Re-uploading it under another name is a duplicate while it's fine...
+    assert upload(pid, "copy.xlsx", b"counts").json["results"] == {"duplicate": ["copy.xlsx"]}
+
+    # The project fixture's app context is still active
+    TMCFile.query.filter_by(project_id=pid).one().latest_job().status = JOB_FAILED
+    db.session.commit()
+
+    # ...but not once its import has failed
+    assert upload(pid, "good_name.xlsx", b"counts").json["results"] == {"new": ["good_name.xlsx"]}
+    assert saved_files(app, pid, folder)[0] == ["Bad_Name.xlsx", "good_name.xlsx"]
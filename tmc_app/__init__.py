@@ -1,12 +1,16 @@
 """Initialize app."""
+import time
 from random import randrange
+from threading import Lock
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
+from flask_compress import Compress
 
 
 db = SQLAlchemy()
 login_manager = LoginManager()
+compress = Compress()
 
 
 def make_random_gradient(style: str = "random") -> str:
@@ -47,8 +51,60 @@ background: linear-gradient({rot1}deg, {_gradient(color1)} 70.71%),
     return text
 
 
-def create_app():
-    """Construct the core app object."""
+class LazyDataExplorer:
+    """
+    WSGI middleware that builds the Data Explorer the first time it's visited.
+
+    Importing Dash and plotly takes most of a second, so the web workers boot
+    without them. Flask won't take new routes once it's serving requests, so
+    the Dash app gets a Flask server of its own, with the same config and
+    database, and requests under its prefix are passed to it.
+    """
+
+    def __init__(self, app: Flask, prefix: str = "/data-explorer"):
+        self.app = app
+        self.wsgi_app = app.wsgi_app
+        self.prefix = prefix
+        self.dashboard = None
+        self.lock = Lock()
+
+    def __call__(self, environ, start_response):
+        if environ.get("PATH_INFO", "").startswith(self.prefix):
+            return self.get_dashboard()(environ, start_response)
+        return self.wsgi_app(environ, start_response)
+
+    def get_dashboard(self):
+        if self.dashboard is None:
+            with self.lock:
+                if self.dashboard is None:
+                    self.dashboard = self.create_server()
+        return self.dashboard
+
+    def create_server(self) -> Flask:
+        from tmc_app.data_viz.dash_app import create_dashboard
+
+        server = Flask(__name__, static_folder=None)
+        server.config.update(self.app.config)
+
+        db.init_app(server)
+        # Share the web app's engine, rather than opening a second pool
+        server.extensions["sqlalchemy"] = self.app.extensions["sqlalchemy"]
+        compress.init_app(server)
+
+        with server.app_context():
+            return create_dashboard(server)
+
+
+def create_app(with_dashboard: bool = True):
+    """
+    Construct the core app object.
+
+    The Data Explorer is only built once somebody opens it, see LazyDataExplorer.
+    The worker doesn't serve pages, so it passes with_dashboard=False
+    and never loads Dash and plotly.
+    """
+    started = time.perf_counter()
+
     app = Flask(__name__,
                 instance_relative_config=False,
                 static_url_path='/static')
@@ -56,9 +112,14 @@ def create_app():
     # Application Configuration
     app.config.from_object('config.Config')
 
+    from tmc_app.models.engines import engine_options
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options(app.config))
+
     # Initialize Plugins
     db.init_app(app)
     login_manager.init_app(app)
+    # gzip the pages, JSON and the Dash figures
+    compress.init_app(app)
 
     with app.app_context():
 
@@ -78,11 +139,14 @@ def create_app():
         # Create Database Models
         db.create_all()
 
-        from tmc_app.data_viz.dash_app import create_dashboard
-        app = create_dashboard(app)
+        if with_dashboard:
+            app.wsgi_app = LazyDataExplorer(app)
 
         # # Compile static assets
         # if app.config['FLASK_ENV'] == 'development':
         #     compile_assets(app)
 
+        # Keep an eye on how long each uWSGI worker takes to boot
+        app.logger.info("Created the app in %.2fs", time.perf_counter() - started)
+
         return app
@@ -0,0 +1,198 @@
+"""
+Server-side cache for query results and figures.
+
+Everything lives in one SQLite file, so all of the uWSGI processes
+(and the background worker) share the same entries. The cache is
+size-bounded: once its pickled values add up to more than CACHE_MAX_BYTES,
+the least recently used ones are evicted. A single figure can be several
+megabytes, so counting entries wouldn't bound the file at all.
+
+Cache keys include a per-project data version. Bumping the version
+with invalidate_project() makes every older entry for that project
+unreachable, and they age out through the normal LRU eviction.
+"""
+import hashlib
+import json
+import pickle
+import sqlite3
+import time
+from pathlib import Path
+
+from tmc_app.models.engines import current_config
+
+
+class SQLiteLRUCache:
+    """ A small pickle-in-SQLite cache with LRU eviction """
+
+    def __init__(self,
+                 path: Path,
+                 max_bytes: int = 256 * 1024 * 1024,
+                 default_timeout: int = 3600):
+
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.default_timeout = default_timeout
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+
+            # Caches from before sizes were tracked are thrown away, they're only a cache
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(entries)")]
+            if columns and "size" not in columns:
+                conn.execute("DROP TABLE entries")
+
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS entries (
+                    key TEXT PRIMARY KEY,
+                    value BLOB NOT NULL,
+                    size INTEGER NOT NULL,
+                    expires REAL NOT NULL,
+                    last_used REAL NOT NULL
+                )""")
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_entries_last_used ON entries (last_used)")
+
+            # Versions are kept apart from the entries so they're never evicted
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS versions (
+                    name TEXT PRIMARY KEY,
+                    version INTEGER NOT NULL
+                )""")
+
+    def _connect(self):
+        return sqlite3.connect(str(self.path), timeout=10)
+
+    def get(self, key: str):
+        now = time.time()
+
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT value, expires FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+
+            if row is None:
+                return None
+
+            value, expires = row
+            if expires < now:
+                conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                return None
+
+            conn.execute("UPDATE entries SET last_used = ? WHERE key = ?", (now, key))
+
+        return pickle.loads(value)
+
+    def set(self, key: str, value, timeout: int = None):
+        if timeout is None:
+            timeout = self.default_timeout
+
+        now = time.time()
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+
+        # It would only push everything else out, and then itself
+        if len(blob) > self.max_bytes:
+            return
+
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO entries (key, value, size, expires, last_used) VALUES (?, ?, ?, ?, ?)",
+                (key, blob, len(blob), now + timeout, now)
+            )
+            self._evict(conn)
+
+    def _evict(self, conn):
+        """ Delete the least recently used entries until the cache fits in max_bytes """
+
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        evicted = []
+        for key, size in conn.execute("SELECT key, size FROM entries ORDER BY last_used"):
+            if total <= self.max_bytes:
+                break
+            evicted.append((key,))
+            total -= size
+
+        conn.executemany("DELETE FROM entries WHERE key = ?", evicted)
+
+    def delete(self, key: str):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    def clear(self):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM entries")
+
+    def version(self, name: str) -> int:
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT version FROM versions WHERE name = ?", (name,)
+            ).fetchone()
+
+        if row is None:
+            return 0
+        return row[0]
+
+    def bump_version(self, name: str) -> int:
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO versions (name, version) VALUES (?, 0)", (name,)
+            )
+            conn.execute(
+                "UPDATE versions SET version = version + 1 WHERE name = ?", (name,)
+            )
+            row = conn.execute(
+                "SELECT version FROM versions WHERE name = ?", (name,)
+            ).fetchone()
+
+        return row[0]
+
+
+_cache = None
+
+
+def get_cache() -> SQLiteLRUCache:
+    """ The cache for this process, configured from CACHE_* in config.py """
+
+    global _cache
+
+    if _cache is None:
+        config = current_config()
+        _cache = SQLiteLRUCache(
+            Path(config["CACHE_DIR"]) / "tmc_cache.sqlite",
+            max_bytes=config["CACHE_MAX_BYTES"],
+            default_timeout=config["CACHE_DEFAULT_TIMEOUT"],
+        )
+
+    return _cache
+
+
+def make_key(*parts) -> str:
+    """ Hash any JSON-friendly key parts into a fixed-length cache key """
+
+    raw = json.dumps(parts, default=str)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def cached(key: str, compute, timeout: int = None):
+    """ Return the cached value for key, calling compute() to fill it on a miss """
+
+    cache = get_cache()
+
+    value = cache.get(key)
+    if value is None:
+        value = compute()
+        cache.set(key, value, timeout)
+
+    return value
+
+
+def project_data_version(project_id: int) -> int:
+    return get_cache().version(f"project-{project_id}")
+
+
+def invalidate_project(project_id: int) -> int:
+    """ Call this whenever a project's data changes """
+    return get_cache().bump_version(f"project-{project_id}")
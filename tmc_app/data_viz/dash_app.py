@@ -1,33 +1,34 @@
 """Instantiate a Dash app."""
-import pandas as pd
 import dash
 import dash_table
 import dash_html_components as html
 import dash_core_components as dcc
-from dash.dependencies import Input, Output, State
+from dash.dependencies import ClientsideFunction, Input, Output, State
 from dash.exceptions import PreventUpdate
 import plotly.graph_objects as go
-# from flask_caching import Cache
 from datetime import time, datetime
 from dotenv import load_dotenv, find_dotenv
+from flask import has_request_context
 import sqlalchemy
+from sqlalchemy.orm import selectinload
 from os import environ
-import plotly.express as px
 
-from tmc_app.models import Project
+from tmc_app.models import Project, TMCFile
+from tmc_app.cache import cached, make_key, project_data_version
 
 load_dotenv(find_dotenv())
 SQLALCHEMY_DATABASE_URI = environ.get("SQLALCHEMY_DATABASE_URI")
 
 
+# How often open pages refresh the project dropdown
+OPTIONS_REFRESH_MS = 60 * 1000
+
 parameter_style = {
     "font-family": "'Roboto Mono', monospace",
     "color": "cyan",
     "font-weight": "bold",
 }
 
-TIMEOUT = 60
-
 
 def make_nice_txt(v):
     """ Turn 5.25 into '5:15' """
@@ -64,69 +65,52 @@ def slider_marks():
     return slider_marks
 
 
-def pad_minute(m):
-    m = str(m)
-    if len(m) == 2:
-        return f":{m}"
-    else:
-        return f":0{m}"
-
-
-def generate_treemap_data(df_timeseries, id_col: str = "location"):
-    """
-    This function consumes the dataframe from df_timeseries()
-    and transforms it to fit the plotly.express.treemap()
-    """
-
-    df_timeseries = df_timeseries.copy()
-
-    # Update with a multi-index to include the file id, then remove the fid column
-    df_timeseries.set_index([df_timeseries[id_col], df_timeseries.index], inplace=True)
-    del df_timeseries[id_col]
-
-    # Stack the dataframe, then reset_index() to explode the multi-index into cols
-    df_stacked = pd.DataFrame(
-        df_timeseries.stack(), columns=["total"]
-    ).reset_index()
-
-    # print(df_timeseries)
-
-    # Remove all rows where the total is zero
-    df_filtered = df_stacked[df_stacked.total != 0]
-
-    # Explode the
-    attribute_cols = {
-        0: "veh_class",
-        1: "leg",
-        2: "movement"
-    }
-    df_attrs = df_filtered['level_2'].str.split(
-        '_', expand=True
-    ).rename(columns=attribute_cols)
-
-    df = pd.concat([df_filtered, df_attrs], axis=1, sort=False)
-    # print(df)
+def placeholder_figure(message: str = "Loading..."):
+    """ An empty figure with a message, shown until a callback draws the real one """
+
+    fig = go.Figure()
+    fig.update_layout(
+        xaxis={"visible": False},
+        yaxis={"visible": False},
+        annotations=[{
+            "text": message,
+            "xref": "paper",
+            "yref": "paper",
+            "showarrow": False,
+            "font": {"size": 18},
+        }],
+    )
+    return fig
 
-    df["hour"] = [str(x.hour) for x in df["time"]]
-    df["minute"] = [pad_minute(x.minute) for x in df["time"]]
 
-    for col in ["level_2", "time"]:
-        del df[col]
+def project_options():
+    """ Dropdown options for every project that has imported data """
 
-    return df
+    return [{"label": name, "value": uid} for uid, name in Project.with_ready_files()]
 
 
 def timeseries_figure(df_timeries,
                     #   figure_margin: dict = dict(l=20, r=20, t=20, b=20),
-                      plot_kwargs: dict = {
-                        "facet_col": "location",
-                        "facet_col_wrap": 2,
-                        "color_discrete_sequence": px.colors.qualitative.Dark24,
-                        "facet_row_spacing": 0.04, # default is 0.07 when facet_col_wrap is used
-                        "facet_col_spacing": 0.04, # default is 0.03
-
-                       }):
+                      plot_kwargs: dict = None):
+    # plotly.express loads pandas, so it's only imported once a figure is drawn
+    import pandas as pd
+    import plotly.express as px
+    from tmc_app.data_viz.get_data import TIME_AXIS, time_axis_values
+
+    if plot_kwargs is None:
+        plot_kwargs = {
+            "facet_col": "location",
+            "facet_col_wrap": 2,
+            "color_discrete_sequence": px.colors.qualitative.Dark24,
+            "facet_row_spacing": 0.04, # default is 0.07 when facet_col_wrap is used
+            "facet_col_spacing": 0.04, # default is 0.03
+        }
+
+    # Numbers instead of "05:00:00" strings, which binary_figure() can pack
+    df_timeries = df_timeries.set_axis(pd.Index(time_axis_values(df_timeries.index), name="time"))
+
     fig = px.bar(df_timeries, **plot_kwargs)
+    fig.update_xaxes(**TIME_AXIS)
     # fig.update_layout(margin=figure_margin)
     # fig.layout.plot_bgcolor = "rgba(0,0,0,0)"
 
@@ -139,6 +123,8 @@ def treemap_figure(df_treemap,
                        "values": "total",
                        "path": ["veh_class", "fid", "leg", "movement", "hour", "minute"],
                     }):
+    import plotly.express as px
+
     fig = px.treemap(df_treemap, **plot_kwargs)
     fig.update_layout(margin=figure_margin)
     return fig
@@ -147,6 +133,8 @@ def treemap_figure(df_treemap,
 def create_dashboard(server):
     """Create a Plotly Dash dashboard."""
 
+    clientside = server.config["DATA_EXPLORER_CLIENTSIDE"]
+
     # Create the dash app with a connection to the larger Flask app via 'server'
     # --------------------------------------------------------------------------
 
@@ -162,52 +150,42 @@ def create_dashboard(server):
                 {'href': 'https://fonts.googleapis.com/css2?family=Roboto+Mono&display=swap',
                     'rel': 'stylesheet',
                 },
-        ]
+        ],
+        external_scripts=["/static/js/data_explorer.js"] if clientside else [],
+        # The Flask app already compresses every response, see create_app()
+        compress=False,
     )
     dash_app.scripts.config.serve_locally = False
-    dcc._js_dist[0]['external_url'] = 'https://cdn.plot.ly/plotly-basic-latest.min.js'
-
-    # Load the initial state of the page
-    # ----------------------------------
-
-    # Load up all the projects from the Flask DB into a list of dicts
-    active_project = Project.query.first()
-    fid_list = [f.uid for f in active_project.files]
-    file_options = [{"label": f.name(), "value": f.uid} for f in active_project.files]
+    # The full bundle has treemaps, and 2.28+ reads the typed arrays from binary_figure()
+    dcc._js_dist[0]['external_url'] = 'https://cdn.plot.ly/plotly-2.35.2.min.js'
 
-    project_options = []
-    all_projects = Project.query.all()
-    for project in all_projects:
-        if project.files:
-            project_options.append({"label": project.name,
-                                    "value": project.uid})
+    # The layout is built for each page view, so the workers
+    # don't touch the database or plotly when they boot
+    dash_app.layout = serve_layout
 
-    # Make a dataframe of the filedata
-
-
-    # LOAD UP THE DATA AND MAKE THE PLOTS
-    # -----------------------------------
-    df_timeseries = active_project.generate_timeseries_data()
-
-    df_treemap = generate_treemap_data(df_timeseries, id_col="location")
-
-    kwargs_timeseries = {
-        "height": len(fid_list) / 2 * 300,
-        "facet_col": "location",
-        "facet_col_wrap": 2,
-        "color_discrete_sequence": px.colors.qualitative.Dark24
-    }
+    init_callbacks(dash_app, clientside=clientside)
+    return dash_app.server
 
 
+def serve_layout():
+    """
+    Build the page with empty placeholder figures.
 
-    plot_timeseries = timeseries_figure(df_timeseries, plot_kwargs=kwargs_timeseries)
+    The callbacks fire as soon as the page loads and draw the real figures.
+    Dash also calls this once at startup to check the callbacks, outside of
+    any request, so the database is only queried while serving a page.
+    """
 
-    kwargs_treeplot = {"path": ["veh_class", "leg", "movement"]}
-    plot_tree = treemap_figure(df_treemap, plot_kwargs=kwargs_treeplot)
+    options = project_options() if has_request_context() else []
 
+    if options:
+        plot_tree = plot_timeseries = placeholder_figure()
+        selected_project = options[0]["value"]
+    else:
+        plot_tree = plot_timeseries = placeholder_figure("No projects have imported data yet")
+        selected_project = None
 
-    # Create Layout
-    dash_app.layout = html.Div([
+    return html.Div([
         html.Nav([
             html.A('Exit', className="nav-item nav-link btn btn-outline-primary btn-sm", href='/projects'),
         ], className="nav navbar mb-2"),
@@ -259,8 +237,8 @@ def create_dashboard(server):
                 html.Span(["Select a project:"]),
                 dcc.Dropdown(
                     id='project-selector',
-                    options=project_options,
-                    value=project_options[0]["value"],
+                    options=options,
+                    value=selected_project,
                 ),
                 html.Br(),
                 html.Span("Select modes to include:"),
@@ -292,6 +270,9 @@ def create_dashboard(server):
                     style={"font-size": "0.7rem"}
                 ),
                 html.P(id="txt-qaqc", className="mt-2"),
+                dcc.Store(id="data-selection"),
+                dcc.Store(id="project-data"),
+                dcc.Interval(id="options-interval", interval=OPTIONS_REFRESH_MS),
             ], className="col-3 mt-5"),
             html.Div([
                 dcc.Graph(
@@ -310,47 +291,127 @@ def create_dashboard(server):
         ], className="row"),
     ], className="container")
 
-    init_callbacks(dash_app)
-    return dash_app.server
+
+def _load_project(pid):
+    """ A project with its files and their jobs, so ready_files() doesn't query once per file """
+    return Project.query.filter_by(
+        uid=pid
+    ).options(
+        selectinload(Project.files).selectinload(TMCFile.jobs)
+    ).first()
+
+
+def _selected_project(selection: dict):
+    return _load_project(selection["pid"])
+
+
+def selection_key(selection: dict) -> str:
+    """
+    The cache key for a selection's data.
+
+    data-selection lives in the browser, so the key is always rebuilt
+    here from the parameters the data is made from, never read from it.
+    """
+    pid = int(selection["pid"])
+
+    return make_key(pid, project_data_version(pid), selection["start"], selection["end"], sorted(selection["modes"]))
+
+
+def timeseries_data(selection: dict):
+    """
+    The timeseries dataframe for a selection made by select_data(), with every file in the project.
+
+    It's normally already in the cache, so the project is only queried on a miss.
+    """
+
+    def _timeseries_data():
+        this_project = _selected_project(selection)
+        return this_project.generate_timeseries_data(
+            start_time=selection["start"],
+            end_time=selection["end"],
+            fids_to_include=[f.uid for f in this_project.ready_files()],
+            modes_to_include=selection["modes"])
+
+    return cached(make_key("timeseries", selection_key(selection)), _timeseries_data)
 
 
-def init_callbacks(dash_app):
-    @dash_app.callback([Output('time-bar-graph', 'figure'),
-                        Output('treemap-graph', 'figure'),
+def project_payload(df_timeseries) -> dict:
+    """
+    A project's timeseries in the compact form that static/js/data_explorer.js filters.
+
+    Each time and location is sent once, and the rows refer to them by index.
+    """
+    import pandas as pd
+
+    time_codes, times = pd.factorize(df_timeseries.index, sort=True)
+    location_codes, locations = pd.factorize(df_timeseries["location"].fillna(""))
+    value_cols = [c for c in df_timeseries.columns if c != "location"]
+
+    return {
+        "times": [t.strftime("%H:%M") for t in times],
+        "minutes": [t.hour * 60 + t.minute for t in times],
+        "locations": list(locations),
+        "columns": value_cols,
+        "time_idx": time_codes.tolist(),
+        "location_idx": location_codes.tolist(),
+        "values": df_timeseries[value_cols].fillna(0).astype("int64").to_numpy().tolist(),
+    }
+
+
+def init_callbacks(dash_app, clientside: bool = False):
+    """
+    Each output only depends on the inputs it uses:
+
+        - project-selector options: refreshed by options-interval
+        - data-selection: project, time range and modes
+        - time-bar-graph: data-selection
+        - treemap-graph: data-selection and the treemap nesting order
+
+    data-selection only holds the parameters of the selected data, never
+    the data itself. The graph callbacks read the data from the server-side
+    cache, under a key rebuilt from those parameters, see selection_key().
+
+    With clientside=True, see init_clientside_callbacks() instead.
+    """
+
+    @dash_app.callback(Output('project-selector', 'options'),
+                       [Input('options-interval', 'n_intervals')],
+                       prevent_initial_call=True)
+    def refresh_projects(n_intervals):
+        """ The page is built with the current options, so this only runs on the timer """
+        return project_options()
+
+    if clientside:
+        init_clientside_callbacks(dash_app)
+        return
+
+    @dash_app.callback([Output('data-selection', 'data'),
                         Output('txt-name', 'children'),
                         Output('txt-start', 'children'),
                         Output('txt-end', 'children'),
-                        Output('project-selector', 'options'),
                         Output('txt-qaqc', 'children'),
                         ],
 
                        [Input('project-selector', 'value'),
                         Input('range-selector', 'value'),
                         Input('mode-selector', 'value'),
-                        Input('treemap-path-order', 'value'),
                         ])
-    def change_project(pid, selected_range, mode_selector, treemap_path_order):
+    def select_data(pid, selected_range, mode_selector):
         """
         Triggers
-            - User changes the PROJECT selection
+            - User changes the PROJECT, time range or modes
 
         Actions
-            - QAQC text 
+            - Caches the timeseries data and shares its key with the graphs
+            - Updates the header and QAQC text
         """
 
-        project_options = []
-        all_projects = Project.query.all()
-        for project in all_projects:
-            if project.files:
-                project_options.append({"label": project.name,
-                                        "value": project.uid})
-
-        # WHEN THE PROJECT SELECTION CHANGES, UPDATE FILE LIST OPTIONS
-        # ------------------------------------------------------------
+        if pid is None:
+            raise PreventUpdate
 
-        # Get the selected project
-        this_project = Project.query.filter_by(uid=pid).first()
-        fid_list = [f.uid for f in this_project.files]
+        # Get the selected project. Files that haven't imported have no data to show
+        this_project = _load_project(pid)
+        fid_list = [f.uid for f in this_project.ready_files()]
 
         # HANDLE THE TIME SLIDER INPUT
         # ----------------------------
@@ -360,59 +421,154 @@ def init_callbacks(dash_app):
         a_txt = make_nice_txt(a)
         b_txt = make_nice_txt(b)
 
-        # Make sure that the end time isn't '24:00'
-        if b == '24:00':
-            b = '23:45'
+        # Everything below is cached on the server. The project's data version
+        # is part of every key, so uploads and deletes invalidate old entries
+        selection = {
+            "pid": pid,
+            "start": a_txt,
+            "end": b_txt,
+            "modes": mode_selector,
+            "fids": fid_list,
+        }
 
-        df_timeseries = this_project.generate_timeseries_data(
-            start_time=a_txt,
-            end_time=b_txt,
-            fids_to_include=fid_list,
-            modes_to_include=mode_selector)
+        df_timeseries = timeseries_data(selection)
 
-        qaqc_txt = None
         if df_timeseries.shape[0] == 0:
             print("No rows were returned from this query")
             raise PreventUpdate
 
-        df_treemap = generate_treemap_data(df_timeseries)
+        qaqc_txt = ""
+
+        return selection, this_project.name, a_txt, b_txt, qaqc_txt
 
+    @dash_app.callback(Output('time-bar-graph', 'figure'),
+                       [Input('data-selection', 'data')])
+    def draw_timeseries(selection):
+        import plotly.express as px
+        from tmc_app.data_viz.get_data import binary_figure
 
-        # # Don't update the plots if the query returns zero rows
-        # if df_timeseries.shape[0] < 1:
-        #     plot_timeseries = existing_time_graph
-        #     plot_tree = existing_tree_graph
-        # else:
+        if not selection:
+            raise PreventUpdate
 
-        if len(fid_list) % 2 == 1:
-            barplot_height = (len(fid_list) + 1) / 2 * 200
+        # select_data() only lists the files that have been imported
+        num_files = len(selection["fids"])
+
+        if num_files % 2 == 1:
+            barplot_height = (num_files + 1) / 2 * 200
             cols = 2
         else:
-            barplot_height = len(fid_list) / 2.0 * 200
+            barplot_height = num_files / 2.0 * 200
             cols = 2
 
         if barplot_height > 1000:
             barplot_height = 1000
             cols = 3
 
-        if not qaqc_txt:
-            qaqc_txt = ""
-
         kwargs_timeseries = {
             "height": barplot_height,
             "facet_col": "location",
             "facet_col_wrap": cols,
             "color_discrete_sequence": px.colors.qualitative.Dark24,
         }
-        plot_timeseries = timeseries_figure(df_timeseries, plot_kwargs=kwargs_timeseries)
 
+        return cached(
+            make_key("timeseries-figure", selection_key(selection), barplot_height, cols),
+            lambda: binary_figure(timeseries_figure(timeseries_data(selection), plot_kwargs=kwargs_timeseries))
+        )
+
+    @dash_app.callback(Output('treemap-graph', 'figure'),
+                       [Input('data-selection', 'data'),
+                        Input('treemap-path-order', 'value'),
+                        ])
+    def draw_treemap(selection, treemap_path_order):
+        from tmc_app.data_viz.get_data import aggregate_treemap_data, binary_figure, generate_treemap_data
+
+        if not selection:
+            raise PreventUpdate
 
         if len(treemap_path_order) < 1:
             print("User did not select any options for the treemap nesting order")
             raise PreventUpdate
-        else:
-            kwargs_treeplot = {"path": treemap_path_order}
-            plot_tree = treemap_figure(df_treemap, plot_kwargs=kwargs_treeplot)
+
+        def _treemap_data():
+            # Only the leaves of the selected path go into the figure
+            this_project = _selected_project(selection)
+            fids = [f.uid for f in this_project.ready_files()]
+
+            if this_project.uses_count_table(fids):
+                df_treemap = this_project.generate_treemap_data(
+                    start_time=selection["start"],
+                    end_time=selection["end"],
+                    fids_to_include=fids,
+                    modes_to_include=selection["modes"],
+                    path=treemap_path_order)
+            else:
+                df_treemap = generate_treemap_data(timeseries_data(selection))
+
+            return aggregate_treemap_data(df_treemap, treemap_path_order)
+
+        treemap_key = make_key("treemap", selection_key(selection), treemap_path_order)
+        kwargs_treeplot = {"values": "total", "path": treemap_path_order}
+
+        return cached(
+            make_key("treemap-figure", treemap_key),
+            lambda: binary_figure(treemap_figure(cached(treemap_key, _treemap_data), plot_kwargs=kwargs_treeplot))
+        )
 
 
-        return plot_timeseries, plot_tree, this_project.name, a_txt, b_txt, project_options, qaqc_txt
\ No newline at end of file
+def init_clientside_callbacks(dash_app):
+    """
+    The server only sends the selected project's data, once per project.
+    The time range, modes and treemap nesting are applied in the browser,
+    by the functions in static/js/data_explorer.js.
+    """
+
+    @dash_app.callback([Output('project-data', 'data'),
+                        Output('txt-name', 'children'),
+                        Output('txt-qaqc', 'children'),
+                        ],
+                       [Input('project-selector', 'value')])
+    def load_project(pid):
+        if pid is None:
+            raise PreventUpdate
+
+        this_project = _load_project(pid)
+
+        # The whole day, with every mode
+        payload = cached(
+            make_key("project-payload", pid, project_data_version(pid)),
+            lambda: project_payload(this_project.generate_timeseries_data(
+                start_time="0:00",
+                end_time="24:00",
+                fids_to_include=[f.uid for f in this_project.ready_files()]))
+        )
+
+        if not payload["time_idx"]:
+            print("No rows were returned from this query")
+            raise PreventUpdate
+
+        qaqc_txt = ""
+
+        return payload, this_project.name, qaqc_txt
+
+    dash_app.clientside_callback(
+        ClientsideFunction(namespace="data_explorer", function_name="filter_timeseries"),
+        [Output('time-bar-graph', 'figure'),
+         Output('txt-start', 'children'),
+         Output('txt-end', 'children'),
+         ],
+        [Input('project-data', 'data'),
+         Input('range-selector', 'value'),
+         Input('mode-selector', 'value'),
+         ]
+    )
+
+    dash_app.clientside_callback(
+        ClientsideFunction(namespace="data_explorer", function_name="filter_treemap"),
+        Output('treemap-graph', 'figure'),
+        [Input('project-data', 'data'),
+         Input('range-selector', 'value'),
+         Input('mode-selector', 'value'),
+         Input('treemap-path-order', 'value'),
+         ]
+    )
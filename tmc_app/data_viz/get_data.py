@@ -1,8 +1,11 @@
+import base64
+
+import numpy as np
 import pandas as pd
-from sqlalchemy import create_engine
 import plotly.express as px
 
 from tmc_app.models import Project
+from tmc_app.models.engines import get_engine
 
 
 def read_sql(query: str, uri: str, index_col="time") -> pd.DataFrame:
@@ -20,53 +23,158 @@ def read_sql(query: str, uri: str, index_col="time") -> pd.DataFrame:
         - dataframe of whatever you queried
     """
 
-    engine = create_engine(uri)
-    df = pd.read_sql(query, engine, index_col=index_col)
-    engine.dispose()
+    df = pd.read_sql(query, get_engine(uri), index_col=index_col)
 
     return df
 
 
-def generate_treemap_data(df_timeseries, id_col: str = "fid"):
+TREEMAP_ATTRIBUTES = ["veh_class", "leg", "movement"]
+
+
+def _label_categories(labels: list, order=None) -> pd.Categorical:
+    """ A categorical of labels, with its categories sorted by order (or the labels themselves) """
+    return pd.Categorical(labels, categories=sorted(set(labels), key=order))
+
+
+def generate_treemap_data(df_timeseries, id_col: str = "location"):
     """
-    This function consumes the dataframe from df_timeseries()
+    This function consumes the dataframe from generate_timeseries_data()
     and transforms it to fit the plotly.express.treemap()
+
+    Every count column is named {veh_class}_{leg}_{movement}, so the names
+    are split once, and the frame is melted with plain index arithmetic:
+    cell (i, j) of the count matrix becomes a row for time i and column j.
+    The text columns are categoricals that share one small set of labels,
+    rather than a string per row.
     """
 
-    df_timeseries = df_timeseries.copy()
+    value_cols = [c for c in df_timeseries.columns if c != id_col]
 
-    # Update with a multi-index to include the file id, then remove the fid column
-    df_timeseries.set_index([df_timeseries[id_col], df_timeseries.index], inplace=True)
-    del df_timeseries[id_col]
+    values = df_timeseries[value_cols].to_numpy()
+    num_rows, num_cols = values.shape
 
-    # Stack the dataframe, then reset_index() to explode the multi-index into cols
-    df_stacked = pd.DataFrame(
-        df_timeseries.stack(), columns=["total"]
-    ).reset_index()
+    flat = values.ravel()
+    keep = np.flatnonzero(pd.notna(flat) & (flat != 0))
 
-    # Remove all rows where the total is zero
-    df_filtered = df_stacked[df_stacked.total != 0]
+    # Row-major order, the same as DataFrame.stack()
+    row_idx = keep // num_cols
+    col_idx = keep % num_cols
 
-    # Explode the
-    attribute_cols = {
-        0: "veh_class",
-        1: "leg",
-        2: "movement"
-    }
-    df_attrs = df_filtered['level_2'].str.split(
-        '_', expand=True
-    ).rename(columns=attribute_cols)
+    df = pd.DataFrame()
+
+    id_codes, ids = pd.factorize(df_timeseries[id_col])
+    df[id_col] = pd.Categorical.from_codes(id_codes[row_idx], categories=ids)
+    df["total"] = flat[keep]
+
+    # Split each column name once, instead of once per row
+    parts = [name.split("_") for name in value_cols]
+    for i, attribute in enumerate(TREEMAP_ATTRIBUTES):
+        labels = _label_categories([p[i] if len(p) > i else "" for p in parts])
+        df[attribute] = pd.Categorical.from_codes(labels.codes[col_idx], categories=labels.categories)
 
-    df = pd.concat([df_filtered, df_attrs], axis=1, sort=False)
-    df["hour"] = [x.hour for x in df["time"]]
-    df["minute"] = [":" + str(x.minute) for x in df["time"]]
+    # There are at most 96 distinct times, so label those and map them back
+    time_codes, times = pd.factorize(df_timeseries.index)
+    time_codes = time_codes[row_idx]
 
-    for col in ["level_2", "time"]:
-        del df[col]
+    hours = _label_categories([str(t.hour) for t in times], order=int)
+    minutes = _label_categories([f":{t.minute:02d}" for t in times])
+    df["hour"] = pd.Categorical.from_codes(hours.codes[time_codes], categories=hours.categories)
+    df["minute"] = pd.Categorical.from_codes(minutes.codes[time_codes], categories=minutes.categories)
 
     return df
 
 
+def aggregate_treemap_data(df_treemap, path: list):
+    """
+    Sum the treemap input down to one row per leaf of the selected path.
+
+    plotly.express.treemap() only needs the leaves, so this keeps the figure
+    (and the JSON sent to the browser) as small as the chosen nesting allows.
+    """
+
+    df = df_treemap.groupby(path, observed=True, sort=False)["total"].sum().reset_index()
+    df = df[df.total != 0].reset_index(drop=True)
+
+    # px.treemap() makes a node for every combination of categories,
+    # even ones with no rows, so hand it plain labels
+    return df.astype({col: object for col in path})
+
+
+# An x axis of times of day. plotly.js reads numbers on a date axis as
+# milliseconds, so times can go out as numbers, see time_axis_values()
+TIME_AXIS = {"type": "date", "tickformat": "%H:%M", "hoverformat": "%H:%M"}
+
+
+def time_axis_values(times) -> np.ndarray:
+    """ Milliseconds after midnight for each time, to plot on a TIME_AXIS """
+    return np.array([(t.hour * 3600 + t.minute * 60 + t.second) * 1000 for t in times], dtype=np.int64)
+
+
+# Trace attributes that hold one number per point
+BINARY_ARRAY_KEYS = ["x", "y", "values"]
+
+
+# Smallest first, see typed_array()
+TYPED_ARRAY_INTS = ["u1", "i1", "u2", "i2", "u4", "i4"]
+
+
+def typed_array(values):
+    """
+    A numeric array in plotly.js's base64 typed-array format, or None for anything else.
+
+    Counts are small whole numbers, which only take 2 or 3 characters each as JSON,
+    so they're packed into the smallest integer type that holds them. That includes
+    float columns with nothing but whole numbers in them. Everything else is float64.
+    This needs plotly.js 2.28 or newer on the page.
+    """
+
+    arr = np.asarray(values)
+    if arr.ndim != 1 or arr.size == 0 or arr.dtype.kind not in "iuf":
+        return None
+
+    if arr.dtype.kind == "f" and np.isfinite(arr).all() and (arr == np.round(arr)).all():
+        arr = arr.astype(np.int64)
+
+    dtype = "f8"
+    if arr.dtype.kind in "iu":
+        low, high = arr.min(), arr.max()
+        for candidate in TYPED_ARRAY_INTS:
+            info = np.iinfo(candidate)
+            if info.min <= low and high <= info.max:
+                dtype = candidate
+                break
+
+    return {
+        "dtype": dtype,
+        "bdata": base64.b64encode(arr.astype(f"<{dtype}").tobytes()).decode("ascii"),
+    }
+
+
+def binary_trace(trace: dict) -> dict:
+    """ Swap a trace's numeric arrays for typed arrays, see typed_array() """
+
+    for key in BINARY_ARRAY_KEYS:
+        if key in trace:
+            encoded = typed_array(trace[key])
+            if encoded is not None:
+                trace[key] = encoded
+
+    return trace
+
+
+def binary_figure(fig) -> dict:
+    """
+    A figure as a dict with its numbers base64 encoded.
+
+    Dash and the templates take the dict like any other figure.
+    """
+
+    fig_dict = fig.to_plotly_json()
+    fig_dict["data"] = [binary_trace(trace) for trace in fig_dict["data"]]
+
+    return fig_dict
+
+
 def timeseries_figure(df_timeries,
                       plot_kwargs: dict = {
                         "facet_col": "fid",
@@ -0,0 +1,413 @@
+"""
+Background jobs.
+
+Routes only save files and add rows to the job table. The worker
+process (see worker.py) claims queued jobs and runs them, importing
+uploaded files in batches.
+"""
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+from pytz import timezone
+from flask import current_app
+from sqlalchemy import func, inspect
+from sqlalchemy.orm.exc import ObjectDeletedError
+
+from tmc_app import db
+from tmc_app.cache import invalidate_project
+from tmc_app.models import (
+    Job,
+    OutputFile,
+    JOB_QUEUED,
+    JOB_RUNNING,
+    JOB_DONE,
+    JOB_FAILED,
+)
+from tmc_app.models.engines import get_engine
+
+# upload_model and summary pull in pandas, pyarrow and xlsxwriter, so they're
+# imported by the job runners. Routes can queue jobs without loading them.
+
+
+def _now():
+    return datetime.now(timezone("US/Eastern"))
+
+
+def _set_progress(job: Job, progress: int, message: str = None):
+    job.progress = progress
+    job.message = message
+    job.heartbeat_on = _now()
+    db.session.commit()
+
+
+def _keep_alive(job_ids: list):
+    """
+    Record that the batch's running jobs are still being worked on.
+
+    Files wait their turn in a batch without reporting any progress, so this
+    stops requeue_stale_jobs() from handing them to another worker.
+    """
+
+    try:
+        Job.query.filter(
+            Job.uid.in_(job_ids),
+            Job.status == JOB_RUNNING
+        ).update({Job.heartbeat_on: _now()}, synchronize_session=False)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f"!!! Couldn't update the batch's heartbeat: {e}")
+
+
+def enqueue_ingest(tmc_file, user_id: int) -> Job:
+    """ Queue up a TMCFile to be imported into SQL. The caller commits. """
+
+    job = Job(
+        kind="ingest",
+        project_id=tmc_file.project_id,
+        file_id=tmc_file.uid,
+        created_by=user_id
+    )
+    db.session.add(job)
+
+    return job
+
+
+def enqueue_summary(project, user_id: int) -> Job:
+    """ Queue up the summary files for a project. The caller commits. """
+
+    job = Job(
+        kind="summary",
+        project_id=project.uid,
+        created_by=user_id
+    )
+    db.session.add(job)
+
+    return job
+
+
+def claim_jobs(limit: int = 1, kind: str = None) -> list:
+    """
+    Mark the oldest queued jobs as running and return them.
+
+    FOR UPDATE SKIP LOCKED lets more than one worker share the queue
+    without picking up the same job.
+    """
+
+    query = Job.query.filter_by(status=JOB_QUEUED)
+    if kind:
+        query = query.filter_by(kind=kind)
+
+    jobs = query.order_by(Job.uid).limit(limit).with_for_update(skip_locked=True).all()
+
+    for job in jobs:
+        job.status = JOB_RUNNING
+        job.started_on = job.heartbeat_on = _now()
+
+    db.session.commit()
+
+    return jobs
+
+
+def requeue_stale_jobs(timeout_minutes: int) -> int:
+    """
+    Put running jobs that haven't made progress for timeout_minutes back in the queue.
+
+    A worker that crashes (uWSGI's attach-daemon then starts a new one)
+    leaves its jobs running, and nothing else would ever pick them up.
+    Jobs that are still being worked on update heartbeat_on, so a long
+    import isn't taken away from a worker that's alive. Jobs claimed
+    before that column existed fall back to started_on.
+    Returns how many jobs were re-queued.
+    """
+
+    cutoff = _now() - timedelta(minutes=timeout_minutes)
+
+    jobs = Job.query.filter(
+        Job.status == JOB_RUNNING,
+        func.coalesce(Job.heartbeat_on, Job.started_on) < cutoff
+    ).with_for_update(skip_locked=True).all()
+
+    for job in jobs:
+        print(f"Re-queueing job {job.uid}, which hasn't made progress since "
+              f"{job.heartbeat_on or job.started_on}")
+        job.status = JOB_QUEUED
+        job.started_on = None
+        job.heartbeat_on = None
+        job.progress = 0
+        job.message = None
+
+    db.session.commit()
+
+    return len(jobs)
+
+
+def claim_next_job():
+    jobs = claim_jobs(limit=1)
+    if jobs:
+        return jobs[0]
+    return None
+
+
+def _save_metadata(tmc_file, metadata: dict, content_hash: str):
+    tmc_file.content_hash = content_hash
+    tmc_file.title = metadata["title"]
+    tmc_file.legs = str(metadata["legs"])
+    tmc_file.data_date = metadata["data_date"]
+    tmc_file.start_time = metadata["start_time"]
+    tmc_file.end_time = metadata["end_time"]
+
+
+def _finish_job(job: Job, error: Exception = None):
+    if error is None:
+        job.status = JOB_DONE
+        job.progress = 100
+        job.message = None
+    else:
+        job.status = JOB_FAILED
+        job.message = f"{type(error).__name__}: {error}"
+        print(f"!!! Job {job.uid} failed: {job.message}")
+
+    job.finished_on = _now()
+    db.session.commit()
+
+
+def _job_id(job: Job) -> int:
+    """ A job's uid, without loading it, so it works after the job's row is deleted """
+    return inspect(job).identity[0]
+
+
+def _still_queued(job: Job) -> bool:
+    """ False if the job was deleted (with its file) since it was claimed """
+    try:
+        job.file_id
+    except ObjectDeletedError:
+        print(f"Job {_job_id(job)} was deleted before it ran")
+        return False
+    return True
+
+
+def _fail_job(job: Job, error: Exception):
+    """
+    Throw away whatever the job left in the session, then record the error.
+
+    If even that fails, e.g. because the file was deleted while it was importing,
+    the error is only printed, so one bad file can't stop the rest of the batch.
+    """
+
+    job_id = _job_id(job)
+    db.session.rollback()
+
+    try:
+        _finish_job(job, error)
+    except Exception as e:
+        db.session.rollback()
+        print(f"!!! Job {job_id} failed with {type(error).__name__}: {error}, "
+              f"and couldn't be marked as failed: {type(e).__name__}: {e}")
+
+
+def _store_frame(project_id: int, file_id: int, df, engine, backend: str):
+    """
+    Save a parsed file with whichever STORAGE_BACKEND is configured,
+    and refresh the project's rollup tables with it.
+
+    This only touches the engine and never db.session, so it's safe to run on a writer thread.
+    """
+    from tmc_app.models.upload_model import SQLUpload, merge_into_project_table, refresh_rollups
+
+    tmc_uploader = SQLUpload(project_id, file_id, None)
+
+    if backend == "long":
+        tmc_uploader.publish_counts(df=df, engine=engine)
+    else:
+        tmc_uploader.publish_to_database(df=df, engine=engine)
+        merge_into_project_table(engine, project_id, file_id)
+
+    refresh_rollups(engine, project_id, file_id, df)
+
+
+def ingest_batch(jobs: list):
+    """
+    Import many TMC files at once.
+
+    The Excel parsing is CPU-bound, so it's spread over a process pool.
+    Files that were parsed before are read from their Parquet snapshots.
+    Parsed frames are written to SQL, and merged into the project table,
+    by a small thread pool, which caps how many database connections
+    the batch uses. Everything that touches
+    db.session stays on this thread. A file that fails only fails its own job,
+    including when its metadata can't be saved.
+    """
+    from tmc_app.models.upload_model import parse_tmc_file, remove_from_project_table
+
+    jobs = [job for job in jobs if _still_queued(job)]
+    if not jobs:
+        return
+
+    config = current_app.config
+    engine = get_engine()
+    backend = config["STORAGE_BACKEND"]
+
+    jobs_by_id = {job.uid: job for job in jobs}
+    parsed_by_id = {}
+
+    # Kept aside, since a failed commit expires the jobs
+    project_ids = {job.uid: job.project_id for job in jobs}
+    file_ids = {job.uid: job.file_id for job in jobs}
+
+    processes = min(config["INGEST_PROCESSES"], len(jobs))
+    connections = min(config["INGEST_DB_CONNECTIONS"], len(jobs))
+
+    with ProcessPoolExecutor(max_workers=processes) as parsers, \
+            ThreadPoolExecutor(max_workers=connections) as writers:
+
+        parsing = {}
+        for job in jobs:
+            try:
+                future = parsers.submit(parse_tmc_file, job.project_id, job.file_id, job.tmc_file.filepath())
+            except Exception as e:
+                # i.e. the file was deleted after its job was claimed
+                _fail_job(job, e)
+                continue
+
+            job.progress = 10
+            job.message = "Reading Excel file"
+            parsing[future] = job.uid
+
+        try:
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            print(f"!!! Couldn't save the batch's progress: {e}")
+
+        writing = {}
+        for future in as_completed(parsing):
+            job_id = parsing[future]
+            job = jobs_by_id[job_id]
+            _keep_alive(list(jobs_by_id))
+            try:
+                df, metadata, content_hash = future.result()
+
+                parsed_by_id[job_id] = (metadata, content_hash)
+                _set_progress(job, 50, "Writing to database")
+            except Exception as e:
+                _fail_job(job, e)
+                continue
+
+            write = writers.submit(_store_frame, project_ids[job_id], file_ids[job_id], df, engine, backend)
+            writing[write] = job_id
+
+        for future in as_completed(writing):
+            job_id = writing[future]
+            job = jobs_by_id[job_id]
+            _keep_alive(list(jobs_by_id))
+            try:
+                future.result()
+            except Exception as e:
+                _fail_job(job, e)
+                continue
+
+            try:
+                job.tmc_file.storage_backend = backend
+                _save_metadata(job.tmc_file, *parsed_by_id[job_id])
+                _finish_job(job)
+            except Exception as e:
+                _fail_job(job, e)
+
+                # Don't leave the rows of a file that didn't import in the project's tables
+                try:
+                    remove_from_project_table(engine, project_ids[job_id], file_ids[job_id])
+                except Exception as cleanup_error:
+                    print(f"!!! Couldn't remove the rows of job {job_id}: {cleanup_error}")
+
+            invalidate_project(project_ids[job_id])
+
+
+def run_summary_job(job: Job):
+    """ Write the project's summary files and list them as OutputFiles """
+    from tmc_app.summary import write_summary_file
+
+    def progress(done, total):
+        _set_progress(job, int(90 * done / total), f"Summarized {done} of {total} files")
+
+    _set_progress(job, 0, "Reading project data")
+    xlsx_path, geojson_path = write_summary_file(
+        job.project,
+        current_app.config["SUMMARY_FILE_FOLDER"],
+        progress=progress
+    )
+
+    for path, analysis_type in [(xlsx_path, "Excel File"), (geojson_path, "GeoJSON File")]:
+        db.session.add(OutputFile(
+            filename=path.name,
+            analysis_type=analysis_type,
+            project_id=job.project_id,
+            created_by=job.created_by
+        ))
+
+
+# Imports don't run on their own, they're batched up by run_worker() and ingest_batch()
+JOB_RUNNERS = {
+    "summary": run_summary_job,
+}
+
+
+def run_job(job: Job):
+    """ Run a claimed job, recording whether it worked """
+
+    try:
+        JOB_RUNNERS[job.kind](job)
+    except Exception as e:
+        _fail_job(job, e)
+    else:
+        try:
+            _finish_job(job)
+        except Exception as e:
+            _fail_job(job, e)
+
+
+def run_worker(poll_interval: float = 2.0):
+    """
+    Process jobs forever. Call this from inside an app context.
+
+    Queued imports are picked up together and run through ingest_batch().
+    At startup, and whenever the queue is empty, running jobs that haven't
+    made progress for JOB_TIMEOUT_MINUTES are re-queued.
+    """
+
+    print("Worker is waiting for jobs")
+
+    timeout = current_app.config["JOB_TIMEOUT_MINUTES"]
+    requeue_stale_jobs(timeout)
+
+    while True:
+        try:
+            job = claim_next_job()
+
+            if job is None:
+                # Pick up anything a crashed worker left behind
+                requeue_stale_jobs(timeout)
+                time.sleep(poll_interval)
+                continue
+
+            if job.kind == "ingest":
+                # Pick up the rest of the upload along with this file
+                batch_size = current_app.config["INGEST_BATCH_SIZE"]
+                jobs = [job] + claim_jobs(limit=batch_size - 1, kind="ingest")
+
+                print(f"Importing {len(jobs)} files")
+                ingest_batch(jobs)
+
+            else:
+                print(f"Running job {job.uid} ({job.kind})")
+                run_job(job)
+
+        except Exception as e:
+            # Whatever went wrong, keep the worker going for the next job
+            print(f"!!! Worker error: {type(e).__name__}: {e}")
+            db.session.rollback()
+            time.sleep(poll_interval)
+
+        finally:
+            # Start each job with a fresh session
+            db.session.remove()
@@ -1,20 +1,93 @@
-from datetime import datetime
+from datetime import datetime, time
 from pytz import timezone
 from pathlib import Path
 from os import environ
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
 from dotenv import load_dotenv, find_dotenv
-from sqlalchemy import create_engine
-import pandas as pd
+from sqlalchemy import bindparam, column, inspect, table
 
+# pandas and tmc_app.models.upload_model are imported inside the methods that use them.
+# Plenty of requests (logins, downloads, the project list) never need them,
+# and skipping them keeps each uWSGI worker quick to boot.
 from tmc_app import db, make_random_gradient
+from tmc_app.models.engines import get_engine
 
 load_dotenv(find_dotenv())
 SUMMARY_FILE_FOLDER = environ.get("SUMMARY_FILE_FOLDER")
 RAW_DATA_FOLDER = environ.get("RAW_DATA_FOLDER")
 SQLALCHEMY_DATABASE_URI = environ.get("SQLALCHEMY_DATABASE_URI")
 
+# Job statuses, see tmc_app.jobs
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+# Column names and types of each project's merged table, see Project._merged_table()
+_merged_columns = {}
+
+# Columns of the rollup tables written by upload_model.refresh_rollups()
+_rollup_columns = {
+    "hourly": [("fid", db.Integer), ("hour", db.Integer), ("mode", db.Text),
+               ("leg", db.Text), ("movement", db.Text), ("count", db.Integer)],
+    "peak": [("fid", db.Integer), ("period", db.Text), ("start_time", db.Time),
+             ("volume", db.Integer), ("phf", db.Float)],
+    "daily": [("fid", db.Integer), ("mode", db.Text), ("leg", db.Text),
+              ("movement", db.Text), ("count", db.Integer)],
+}
+
+
+def _as_time(value) -> time:
+    """ Turn '5:15' into time(5, 15). Anything from '24:00' on is the end of the day. """
+
+    if isinstance(value, time):
+        return value
+
+    hour, minute = [int(x) for x in str(value).split(":")[:2]]
+    if hour >= 24:
+        return time.max
+
+    return time(hour, minute)
+
+
+def _whole_hours(start_time, end_time):
+    """ (start hour, end hour) if both ends fall on the hour, otherwise None. '24:00' ends at hour 24. """
+
+    start = _as_time(start_time)
+    end = _as_time(end_time)
+
+    if start.minute or start.second:
+        return None
+    if end == time.max:
+        return start.hour, 24
+    if end.minute or end.second:
+        return None
+
+    return start.hour, end.hour
+
+
+def _ready_files_query(*columns):
+    """
+    Query columns of ready files, from one statement.
+
+    Like TMCFile.is_ready(), a file is ready when its latest job is done,
+    or when it has no jobs at all.
+    """
+
+    latest = db.session.query(
+        Job.file_id, db.func.max(Job.uid).label("job_id")
+    ).filter(Job.file_id.isnot(None)).group_by(Job.file_id).subquery()
+
+    return db.session.query(*columns).select_from(TMCFile).outerjoin(
+        latest, latest.c.file_id == TMCFile.uid
+    ).outerjoin(
+        Job, Job.uid == latest.c.job_id
+    ).filter(
+        db.or_(latest.c.job_id.is_(None), Job.status == JOB_DONE)
+    )
+
+
 class User(UserMixin, db.Model):
     """User account model."""
 
@@ -95,7 +168,9 @@ class User(UserMixin, db.Model):
         ).all()
 
     def num_projects_created(self):
-        return len(self.projects_created())
+        return Project.query.filter_by(
+            created_by=self.id
+        ).count()
 
     def files_created(self):
         return TMCFile.query.filter_by(
@@ -103,7 +178,9 @@ class User(UserMixin, db.Model):
         ).all()
 
     def num_files_created(self):
-        return len(self.files_created())
+        return TMCFile.query.filter_by(
+            uploaded_by=self.id
+        ).count()
 
 
 class Project(db.Model):
@@ -138,25 +215,51 @@ class Project(db.Model):
 
     files = db.relationship("TMCFile", backref=__tablename__, lazy=True)
     output_files = db.relationship("OutputFile", backref=__tablename__, lazy=True)
+    creator = db.relationship("User", lazy=True)
+
+    @staticmethod
+    def file_counts() -> dict:
+        """ Number of files in every project, from one GROUP BY query """
+        rows = db.session.query(
+            TMCFile.project_id, db.func.count(TMCFile.uid)
+        ).group_by(TMCFile.project_id).all()
+
+        return dict(rows)
+
+    @staticmethod
+    def with_ready_files() -> list:
+        """ (uid, name) of every project with at least one ready file, from one query """
+
+        return _ready_files_query(Project.uid, Project.name).join(
+            Project, Project.uid == TMCFile.project_id
+        ).distinct().order_by(Project.uid).all()
 
     def num_files(self):
         return len(self.files)
 
+    def ready_files(self):
+        """ Files that have been imported into SQL """
+        return [f for f in self.files if f.is_ready()]
+
+    def has_pending_jobs(self):
+        return Job.query.filter(
+            Job.project_id == self.uid,
+            Job.status.in_([JOB_QUEUED, JOB_RUNNING])
+        ).count() > 0
+
     def file_uploaders(self):
         all_uploaders = []
         all_uploader_ids = []
         for f in self.files:
             user_id = int(f.uploaded_by)
             if user_id not in all_uploader_ids:
-
-                user = User.query.filter_by(id=user_id).first()
                 all_uploader_ids.append(user_id)
-                all_uploaders.append(user)
+                all_uploaders.append(f.uploader)
 
         return all_uploaders
 
     def created_by_user(self):
-        return User.query.filter_by(id=self.created_by).first()
+        return self.creator
 
     def safe_folder_name(self):
 
@@ -180,68 +283,598 @@ class Project(db.Model):
 
     def create_project_table(self,
                              uri: str = SQLALCHEMY_DATABASE_URI,):
+        """
+        Rebuild the merged table from scratch.
+
+        Uploads and deletes keep it up to date on their own through
+        add_file_to_project_table() and remove_file_from_project_table(),
+        so this is only needed to repair a project. The rollup tables
+        are rebuilt along the way, for files in countdata too.
+        Those files aren't part of the merged table.
+        """
+        import pandas as pd
+        from tmc_app.models.upload_model import normalize_time_column, refresh_rollups, write_frame
+
+        engine = get_engine(uri)
 
         all_dfs = []
 
-        for f in self.files:
-            engine = create_engine(uri)
-            df = pd.read_sql(f"SELECT * FROM data_p{self.uid}_f{f.uid}", engine, index_col="time")
-            engine.dispose()
+        for f in self.ready_files():
+            if f.uses_count_table():
+                refresh_rollups(engine, self.uid, f.uid, f.read_counts(engine))
+                continue
+
+            table_name = f"data_p{self.uid}_f{f.uid}"
+            df = pd.read_sql(f"SELECT * FROM {table_name}", engine, index_col="time")
+            df.index = normalize_time_column(df.index.to_series(), table_name).values
+            df.index.name = "time"
+
+            refresh_rollups(engine, self.uid, f.uid, df)
             all_dfs.append(df)
 
+        if not all_dfs:
+            return
+
         df = pd.concat(all_dfs)
 
-        engine = create_engine(uri)
-        df.to_sql(f"data_merged_p{self.uid}", engine, if_exists="replace")
-        engine.dispose()
+        write_frame(df, f"data_merged_p{self.uid}", engine, if_exists="replace")
+
+    def _merged_table(self, engine):
+        """
+        A lightweight table() for data_merged_p{uid}.
+
+        The column list is cached per project and only re-read
+        when the project's data version changes.
+        """
+
+        # tmc_app.cache imports tmc_app.models.engines, so it can't be imported at the top
+        from tmc_app.cache import project_data_version
+
+        table_name = f"data_merged_p{self.uid}"
+        version = project_data_version(self.uid)
+
+        columns = _merged_columns.get(self.uid)
+        if columns is None or columns[0] != version:
+            inspected = inspect(engine).get_columns(table_name)
+            columns = (version, [(col["name"], col["type"]) for col in inspected])
+            _merged_columns[self.uid] = columns
+
+        # SQLite reports columns made by CREATE TABLE AS as NUMERIC,
+        # so set the type that the time parameters are bound with
+        columns = [(name, db.Time() if name == "time" else col_type) for name, col_type in columns[1]]
+
+        return table(table_name, *[column(name, col_type) for name, col_type in columns])
+
+    def _rollup_table(self, kind: str):
+        """ A lightweight table() for one of this project's ROLLUP_TABLES """
+        from tmc_app.models.upload_model import ROLLUP_TABLES
+
+        table_name = ROLLUP_TABLES[kind].format(project_id=self.uid)
+        return table(table_name, *[column(name, col_type()) for name, col_type in _rollup_columns[kind]])
+
+    def has_rollups(self,
+                    fids_to_include: list,
+                    uri: str = SQLALCHEMY_DATABASE_URI,):
+        """
+        Do the rollup tables cover every one of these files?
+
+        Files imported before the rollups existed won't be in them until
+        create_project_table() is run, so the read paths check first.
+        """
+
+        engine = get_engine(uri)
+        hourly = self._rollup_table("hourly")
+
+        with engine.connect() as conn:
+            if not engine.dialect.has_table(conn, hourly.name):
+                return False
+
+        fids = {int(x) for x in fids_to_include}
+        num_covered = db.session.query(
+            db.func.count(db.distinct(hourly.c.fid))
+        ).filter(hourly.c.fid.in_(fids)).scalar()
+
+        return num_covered == len(fids)
+
+    def _use_hourly_rollup(self,
+                           fids_to_include: list,
+                           uri: str,
+                           start_time: str,
+                           end_time: str):
+        """ The (start hour, end hour) to read from the hourly rollup, or None if it can't answer this request """
+
+        hours = _whole_hours(start_time, end_time)
+        if hours is None or not self.has_rollups(fids_to_include, uri):
+            return None
+
+        return hours
+
+    def _fids_by_backend(self, fids_to_include: list):
+        """
+        Split file ids into (wide, long), by where each file's counts were stored.
+
+        STORAGE_BACKEND only applies to new imports, so a project can have both.
+        Files that haven't been imported (yet) aren't in either store, so they're left out.
+        """
+
+        fids = [int(x) for x in fids_to_include]
+        backends = dict(_ready_files_query(TMCFile.uid, TMCFile.storage_backend).filter(
+            TMCFile.uid.in_(fids),
+        ).all())
+
+        ready = [x for x in fids if x in backends]
+
+        return [x for x in ready if backends[x] != "long"], [x for x in ready if backends[x] == "long"]
+
+    def uses_count_table(self, fids_to_include: list = None):
+        """ Are all of these files stored in countdata? See STORAGE_BACKEND in config.py """
+
+        if not fids_to_include:
+            fids_to_include = [f.uid for f in self.ready_files()]
+
+        wide_fids, long_fids = self._fids_by_backend(fids_to_include)
+        return bool(long_fids) and not wide_fids
+
+    def _count_query(self,
+                     fids_to_include: list,
+                     start_time: str,
+                     end_time: str,
+                     modes_to_include: list,
+                     *columns):
+        """ Query countdata for this project, with everything passed as bound parameters """
+
+        return db.session.query(*columns).join(
+            TMCFile, TMCFile.uid == TMCCount.file_id
+        ).filter(
+            TMCCount.project_id == self.uid,
+            TMCCount.file_id.in_([int(x) for x in fids_to_include]),
+            TMCCount.mode.in_(list(modes_to_include)),
+            TMCCount.time >= _as_time(start_time),
+            TMCCount.time < _as_time(end_time),
+        )
+
+    def generate_treemap_data(self,
+                              fids_to_include: list = None,
+                              uri: str = SQLALCHEMY_DATABASE_URI,
+                              start_time: str = "5:00",
+                              end_time: str = "20:00",
+                              modes_to_include: list = ["heavy", "light", "bikes", "peds"],
+                              path: list = None):
+        """
+        Build the plotly.express.treemap() input straight from countdata.
+        Only for files stored there, see uses_count_table().
+
+        The totals are summed in SQL, so there's no need to stack
+        the wide timeseries dataframe. With a treemap path, only the columns
+        in the path are grouped on (time too, if it has hour or minute).
+        """
+        import pandas as pd
+
+        if not fids_to_include:
+            fids_to_include = [f.uid for f in self.ready_files()]
+
+        location = db.func.coalesce(TMCFile.title, TMCFile.filename)
+        total = db.func.sum(TMCCount.count)
+
+        group_columns = {
+            "location": location,
+            "veh_class": TMCCount.mode,
+            "leg": TMCCount.leg,
+            "movement": TMCCount.movement,
+            "time": TMCCount.time,
+        }
+        if path:
+            group_columns = {
+                name: col for name, col in group_columns.items()
+                if name in path or (name == "time" and ("hour" in path or "minute" in path))
+            }
+
+        query = self._count_query(
+            fids_to_include, start_time, end_time, modes_to_include,
+            total.label("total"),
+            *[col.label(name) for name, col in group_columns.items()],
+        ).group_by(
+            *group_columns.values()
+        ).having(total != 0)
+
+        df = pd.read_sql(query.statement, get_engine(uri))
+
+        if "time" in df.columns:
+            # There are at most 96 distinct times, so label those and map them back
+            times = df.pop("time")
+            unique_times = times.unique()
+            df["hour"] = times.map({t: str(t.hour) for t in unique_times})
+            df["minute"] = times.map({t: f":{t.minute:02d}" for t in unique_times})
+
+        return df
+
+    def add_file_to_project_table(self,
+                                  fid: int,
+                                  uri: str = SQLALCHEMY_DATABASE_URI,):
+        from tmc_app.models.upload_model import merge_into_project_table
+
+        merge_into_project_table(get_engine(uri), self.uid, fid)
+
+    def remove_file_from_project_table(self,
+                                       fid: int,
+                                       uri: str = SQLALCHEMY_DATABASE_URI,):
+        from tmc_app.models.upload_model import remove_from_project_table
+
+        remove_from_project_table(get_engine(uri), self.uid, fid)
 
     def generate_timeseries_data(self,
                                  fids_to_include: list = None,
                                  uri: str = SQLALCHEMY_DATABASE_URI,
                                  start_time: str = "5:00",
                                  end_time: str = "20:00",
-                                 modes_to_include: list = ["heavy", "light", "bikes", "peds"]):
+                                 modes_to_include: list = ["heavy", "light", "bikes", "peds"],
+                                 resolution: str = "15min"):
         """
         This function creates a dataframe that is tailored to plotly.express.bar()
+
+        resolution is either "15min" or "hour". Hourly requests that start and end
+        on the hour are read from the project's hourly rollup when it covers
+        every file, and are summed up from the 15-minute rows otherwise.
         """
+        import pandas as pd
 
         if not fids_to_include:
-            fids_to_include = [f.uid for f in self.files]
+            fids_to_include = [f.uid for f in self.ready_files()]
 
-        fids_to_include = [str(x) for x in fids_to_include]
+        if resolution == "hour":
+            hours = self._use_hourly_rollup(fids_to_include, uri, start_time, end_time)
+            if hours:
+                return self._timeseries_from_rollup(fids_to_include, uri, hours, modes_to_include)
 
-        engine = create_engine(uri)
-        df_sample = pd.read_sql(f"SELECT * FROM data_merged_p{self.uid} LIMIT 1", uri)
-        engine.dispose()
+            df = self.generate_timeseries_data(fids_to_include, uri, start_time, end_time, modes_to_include)
 
-        q = "SELECT time, CASE WHEN f.title IS NULL THEN f.filename ELSE f.title END AS location, "
+            hour_index = df.index.map(lambda t: time(t.hour)).rename("time")
+            return df.groupby([hour_index, "location"], sort=True).sum().reset_index("location")
 
-        for col in df_sample.columns:
-            if col != 'fid':
+        wide_fids, long_fids = self._fids_by_backend(fids_to_include)
 
-                # Confirm it's in the mode list
-                wt = col.split("_")[0]
-                if wt in modes_to_include:
-                    q += f" {col}, "
+        dfs = []
+        if long_fids:
+            dfs.append(self._timeseries_from_counts(long_fids, uri, start_time, end_time, modes_to_include))
+        if wide_fids or not long_fids:
+            dfs.append(self._timeseries_from_merged(wide_fids, uri, start_time, end_time, modes_to_include))
+
+        if len(dfs) == 1:
+            return dfs[0]
 
-        q = q[:-2] + f" FROM data_merged_p{self.uid}"
+        # Files with different legs have different columns
+        return pd.concat(dfs).fillna(0)
 
-        q += " LEFT JOIN filedata f on f.uid = fid"
+    def _timeseries_from_merged(self,
+                                fids_to_include: list,
+                                uri: str,
+                                start_time: str,
+                                end_time: str,
+                                modes_to_include: list):
+        """ Same output as generate_timeseries_data(), read from data_merged_p{uid} """
+        import pandas as pd
+
+        engine = get_engine(uri)
+        merged = self._merged_table(engine)
+        f = TMCFile.__table__.alias("f")
+
+        selected = [
+            merged.c.time,
+            db.func.coalesce(f.c.title, f.c.filename).label("location"),
+        ]
+
+        for col in merged.columns:
+            if col.name not in ['time', 'fid']:
+
+                # Confirm it's in the mode list
+                wt = col.name.split("_")[0]
+                if wt in modes_to_include:
+                    selected.append(col)
+
+        # Everything that comes from the Data Explorer is a bound parameter,
+        # so none of it ends up in the SQL text
+        query = db.session.query(*selected).select_from(
+            merged.outerjoin(f, f.c.uid == merged.c.fid)
+        ).filter(
+            merged.c.time >= bindparam("start_time"),
+            merged.c.time < bindparam("end_time"),
+            merged.c.fid.in_(bindparam("fids", expanding=True)),
+        )
 
-        q += f"""
-            WHERE time >= '{start_time}'
-                AND time < '{end_time}'
-                AND fid IN ({", ".join(fids_to_include)}) """
+        params = {
+            "start_time": _as_time(start_time),
+            "end_time": _as_time(end_time),
+            "fids": [int(x) for x in fids_to_include],
+        }
 
-        engine = create_engine(uri)
-        df = pd.read_sql(q, uri, index_col="time")
-        engine.dispose()
+        df = pd.read_sql(query.statement, engine, params=params, index_col="time")
 
         # Replace any None values with nan
         df.fillna(value=0, inplace=True)
 
         return df
 
+    def _timeseries_from_counts(self,
+                                fids_to_include: list,
+                                uri: str,
+                                start_time: str,
+                                end_time: str,
+                                modes_to_include: list):
+        """
+        Same output as generate_timeseries_data(), read from countdata.
+
+        Mode and time filtering happen in SQL, then the rows are pivoted
+        back out to one column per mode/leg/movement.
+        """
+        import pandas as pd
+
+        query = self._count_query(
+            fids_to_include, start_time, end_time, modes_to_include,
+            TMCCount.time,
+            db.func.coalesce(TMCFile.title, TMCFile.filename).label("location"),
+            TMCCount.mode,
+            TMCCount.leg,
+            TMCCount.movement,
+            TMCCount.count,
+        )
+
+        df = pd.read_sql(query.statement, get_engine(uri))
+
+        return _pivot_counts(df)
+
+    def _timeseries_from_rollup(self,
+                                fids_to_include: list,
+                                uri: str,
+                                hours: tuple,
+                                modes_to_include: list):
+        """ Hourly version of generate_timeseries_data(), read from rollup_hourly_p{uid} """
+        import pandas as pd
+
+        hourly = self._rollup_table("hourly")
+        f = TMCFile.__table__.alias("f")
+
+        query = db.session.query(
+            hourly.c.hour,
+            db.func.coalesce(f.c.title, f.c.filename).label("location"),
+            hourly.c.mode,
+            hourly.c.leg,
+            hourly.c.movement,
+            hourly.c.count,
+        ).select_from(
+            hourly.outerjoin(f, f.c.uid == hourly.c.fid)
+        ).filter(
+            hourly.c.fid.in_(bindparam("fids", expanding=True)),
+            hourly.c.mode.in_(bindparam("modes", expanding=True)),
+            hourly.c.hour >= bindparam("start_hour"),
+            hourly.c.hour < bindparam("end_hour"),
+        )
+
+        params = {
+            "fids": [int(x) for x in fids_to_include],
+            "modes": list(modes_to_include),
+            "start_hour": hours[0],
+            "end_hour": hours[1],
+        }
+
+        df = pd.read_sql(query.statement, get_engine(uri), params=params)
+        df["time"] = df.pop("hour").map(lambda hour: time(int(hour)))
+
+        return _pivot_counts(df)
+
+    def peak_hours(self,
+                   fids_to_include: list = None,
+                   uri: str = SQLALCHEMY_DATABASE_URI,):
+        """
+        AM and PM peak hours for each file, from rollup_peak_p{uid}.
+
+        Returns fid, location, period, start_time, volume and phf columns.
+        """
+
+        if not fids_to_include:
+            fids_to_include = [f.uid for f in self.ready_files()]
+
+        return self._read_rollup("peak", fids_to_include, uri, ["period", "start_time", "volume", "phf"])
+
+    def daily_totals(self,
+                     fids_to_include: list = None,
+                     uri: str = SQLALCHEMY_DATABASE_URI,):
+        """
+        Whole-day totals per file, mode, leg and movement, from rollup_daily_p{uid}.
+
+        Returns fid, location, mode, leg, movement and count columns.
+        """
+
+        if not fids_to_include:
+            fids_to_include = [f.uid for f in self.ready_files()]
+
+        return self._read_rollup("daily", fids_to_include, uri, ["mode", "leg", "movement", "count"])
+
+    def _read_rollup(self,
+                     kind: str,
+                     fids_to_include: list,
+                     uri: str,
+                     column_names: list):
+        import pandas as pd
+
+        rollup = self._rollup_table(kind)
+        f = TMCFile.__table__.alias("f")
+
+        query = db.session.query(
+            rollup.c.fid,
+            db.func.coalesce(f.c.title, f.c.filename).label("location"),
+            *[rollup.c[name] for name in column_names]
+        ).select_from(
+            rollup.outerjoin(f, f.c.uid == rollup.c.fid)
+        ).filter(
+            rollup.c.fid.in_(bindparam("fids", expanding=True)),
+        ).order_by(rollup.c.fid)
+
+        params = {"fids": [int(x) for x in fids_to_include]}
+
+        return pd.read_sql(query.statement, get_engine(uri), params=params)
+
+    def generate_location_totals(self,
+                                 fids_to_include: list = None,
+                                 uri: str = SQLALCHEMY_DATABASE_URI,
+                                 start_time: str = "5:00",
+                                 end_time: str = "20:00",
+                                 hourly: bool = False):
+        """
+        Total volume per location and time bin, summed in SQL.
+
+        This is everything the overview chart needs, so the full
+        timeseries never has to leave the database. With hourly=True
+        the 15-minute bins are rolled up into hours, using the hourly
+        rollup table when it has every file.
+
+        Returns a dataframe with time, location and total columns, sorted by time.
+        """
+        import pandas as pd
+
+        if not fids_to_include:
+            fids_to_include = [f.uid for f in self.ready_files()]
+
+        engine = get_engine(uri)
+
+        hours = None
+        if hourly:
+            hours = self._use_hourly_rollup(fids_to_include, uri, start_time, end_time)
+
+        if hours:
+            queries = [self._location_totals_from_rollup(fids_to_include, hours)]
+        else:
+            wide_fids, long_fids = self._fids_by_backend(fids_to_include)
+
+            queries = []
+            if long_fids:
+                queries.append(self._location_totals_from_counts(long_fids, start_time, end_time, hourly))
+            if wide_fids or not long_fids:
+                queries.append(self._location_totals_from_merged(engine, wide_fids, start_time, end_time, hourly))
+
+        dfs = [pd.read_sql(query.statement, engine, params=params) for query, params in queries]
+
+        df = dfs[0]
+        if len(dfs) > 1:
+            df = pd.concat(dfs).groupby(["time", "location"], as_index=False, sort=True)["total"].sum()
+
+        if hourly:
+            df["time"] = df["time"].map(lambda hour: time(int(hour)))
+
+        df["total"] = df["total"].fillna(0)
+
+        return df
+
+    def _location_totals_from_rollup(self,
+                                     fids_to_include: list,
+                                     hours: tuple):
+        """ (query, params) for generate_location_totals(), read from rollup_hourly_p{uid} """
+
+        rollup = self._rollup_table("hourly")
+        f = TMCFile.__table__.alias("f")
+
+        time_col = rollup.c.hour
+        location = db.func.coalesce(f.c.title, f.c.filename)
+
+        query = db.session.query(
+            time_col.label("time"),
+            location.label("location"),
+            db.func.sum(rollup.c.count).label("total"),
+        ).select_from(
+            rollup.outerjoin(f, f.c.uid == rollup.c.fid)
+        ).filter(
+            rollup.c.fid.in_(bindparam("fids", expanding=True)),
+            rollup.c.hour >= bindparam("start_hour"),
+            rollup.c.hour < bindparam("end_hour"),
+        ).group_by(time_col, location).order_by(time_col)
+
+        params = {
+            "fids": [int(x) for x in fids_to_include],
+            "start_hour": hours[0],
+            "end_hour": hours[1],
+        }
+
+        return query, params
+
+    def _location_totals_from_counts(self,
+                                     fids_to_include: list,
+                                     start_time: str,
+                                     end_time: str,
+                                     hourly: bool):
+        """ (query, params) for generate_location_totals(), read from countdata """
+
+        time_col = TMCCount.time
+        total = db.func.sum(TMCCount.count)
+        location = db.func.coalesce(TMCFile.title, TMCFile.filename)
+
+        if hourly:
+            time_col = db.cast(db.extract("hour", time_col), db.Integer)
+
+        query = self._count_query(
+            fids_to_include, start_time, end_time, ["heavy", "light", "bikes", "peds"],
+            time_col.label("time"),
+            location.label("location"),
+            total.label("total"),
+        ).group_by(time_col, location).order_by(time_col)
+
+        return query, {}
+
+    def _location_totals_from_merged(self,
+                                     engine,
+                                     fids_to_include: list,
+                                     start_time: str,
+                                     end_time: str,
+                                     hourly: bool):
+        """ (query, params) for generate_location_totals(), read from data_merged_p{uid} """
+
+        merged = self._merged_table(engine)
+        f = TMCFile.__table__.alias("f")
+
+        count_cols = [col for col in merged.columns if col.name not in ['time', 'fid']]
+        row_total = sum(db.func.coalesce(col, 0) for col in count_cols)
+
+        time_col = merged.c.time
+        if hourly:
+            time_col = db.cast(db.extract("hour", time_col), db.Integer)
+
+        location = db.func.coalesce(f.c.title, f.c.filename)
+
+        query = db.session.query(
+            time_col.label("time"),
+            location.label("location"),
+            db.func.sum(row_total).label("total"),
+        ).select_from(
+            merged.outerjoin(f, f.c.uid == merged.c.fid)
+        ).filter(
+            merged.c.time >= bindparam("start_time"),
+            merged.c.time < bindparam("end_time"),
+            merged.c.fid.in_(bindparam("fids", expanding=True)),
+        ).group_by(time_col, location).order_by(time_col)
+
+        params = {
+            "start_time": _as_time(start_time),
+            "end_time": _as_time(end_time),
+            "fids": [int(x) for x in fids_to_include],
+        }
+
+        return query, params
+
+
+def _pivot_counts(df):
+    """ Pivot long time/location/mode/leg/movement/count rows out to one column per movement """
+
+    df["column"] = df["mode"] + "_" + df["leg"] + "_" + df["movement"]
+
+    df = df.pivot_table(
+        index=["time", "location"],
+        columns="column",
+        values="count",
+        aggfunc="sum",
+        fill_value=0
+    ).reset_index("location")
+    df.columns.name = None
+
+    return df
+
 
 class TMCFile(db.Model):
 
@@ -306,6 +939,27 @@ class TMCFile(db.Model):
         nullable=True,
         unique=False
     )
+    content_hash = db.Column(
+        db.String(64),
+        nullable=True,
+        unique=False
+    )
+    # Where the worker stored the counts, "wide" or "long" (see STORAGE_BACKEND).
+    # Files imported before this column existed are wide.
+    storage_backend = db.Column(
+        db.String(10),
+        nullable=True,
+        unique=False
+    )
+
+    uploader = db.relationship("User", lazy=True)
+    jobs = db.relationship(
+        "Job",
+        backref="tmc_file",
+        lazy=True,
+        cascade="all, delete-orphan",
+        order_by="Job.uid"
+    )
 
     def name(self):
         if self.title:
@@ -314,59 +968,99 @@ class TMCFile(db.Model):
             return self.filename
 
     def upload_user(self):
-        return User.query.filter_by(id=self.uploaded_by).first()
+        return self.uploader
 
     def filepath(self):
-        project = Project.query.filter_by(uid=self.project_id).first()
+        return Path(RAW_DATA_FOLDER) / self.projects.safe_folder_name() / self.filename
+
+    def snapshot_path(self):
+        """ Where the Parquet copy of this file lives, once it has been imported """
+        from tmc_app.models.upload_model import snapshot_path
+
+        if not self.content_hash:
+            return None
+        return snapshot_path(self.filepath().parent, self.content_hash)
+
+    def delete_snapshot(self):
+        """ Remove the Parquet copy, unless another file in the project has the same contents """
+
+        path = self.snapshot_path()
+        others = [f for f in self.projects.files if f is not self]
 
-        return Path(RAW_DATA_FOLDER) / project.safe_folder_name() / self.filename
+        if path and not any(f.content_hash == self.content_hash for f in others):
+            path.unlink(missing_ok=True)
+
+    def read_parsed(self):
+        """
+        Get (df, metadata) for this file, like SQLUpload.read_workbook().
+
+        The Parquet snapshot is used whenever possible, and the
+        Excel file is only parsed when there isn't one yet.
+        This may set content_hash, so the caller commits.
+        """
+        from tmc_app.models.upload_model import parse_tmc_file, read_snapshot
+
+        path = self.snapshot_path()
+        if path:
+            parsed = read_snapshot(path, self.uid)
+            if parsed:
+                return parsed
+
+        df, metadata, self.content_hash = parse_tmc_file(self.project_id, self.uid, self.filepath())
+
+        return df, metadata
 
     def extract_metadata(self):
-        location_kwargs = {
-            "sheet_name": "Information",
-            "header": None,
-            "usecols": "A:B",
-            "names": ["place_type", "place_name"]
-        }
+        import pandas as pd
+        from tmc_app.models.upload_model import INFORMATION_TAB, parse_metadata, read_snapshot
 
-        df_location = pd.read_excel(self.filepath(), **location_kwargs).dropna()
+        path = self.snapshot_path()
+        if path:
+            parsed = read_snapshot(path, self.uid)
+            if parsed:
+                return parsed[1]
 
-        location_kwargs["usecols"] = "D:E"
-        location_kwargs["names"] = ["time_type", "time_value"]
+        df_info = pd.read_excel(self.filepath(), sheet_name=INFORMATION_TAB, header=None)
 
-        df_time = pd.read_excel(self.filepath(), **location_kwargs).dropna()
+        return parse_metadata(df_info)
 
-        data_date = None
-        start_time = ""
-        end_time = ""
-        location_name = ""
-        legs = {}
+    def uses_count_table(self):
+        """ Was this file stored in countdata? """
+        return self.storage_backend == "long"
 
-        # Get the location_name and leg names
-        for _, row in df_location.iterrows():
+    def read_counts(self, engine):
+        """ This file's rows of countdata, pivoted back out to one column per mode/leg/movement """
+        import pandas as pd
 
-            if row.place_type == "Intersection Name":
-                location_name = row.place_name
-            else:
-                legs[row.place_type.lower()] = row.place_name
+        query = db.session.query(
+            TMCCount.time,
+            TMCCount.mode,
+            TMCCount.leg,
+            TMCCount.movement,
+            TMCCount.count,
+        ).filter(TMCCount.file_id == self.uid)
 
-        # Get the date and start/end times
-        for _, row in df_time.iterrows():
+        df = pd.read_sql(query.statement, engine)
+        df["column"] = df["mode"] + "_" + df["leg"] + "_" + df["movement"]
 
-            if row.time_type == "Date":
-                data_date = row.time_value
-            elif row.time_type == "Start Time":
-                start_time = row.time_value
-            elif row.time_type == "End Time":
-                end_time = row.time_value
+        df = df.pivot_table(index="time", columns="column", values="count", aggfunc="sum")
+        df.columns.name = None
 
-        return {
-            "title": location_name,
-            "legs": legs,
-            "data_date": data_date,
-            "start_time": start_time,
-            "end_time": end_time,
-        }
+        return df
+
+    def latest_job(self):
+        if self.jobs:
+            return self.jobs[-1]
+        return None
+
+    def is_ready(self):
+        """ Files uploaded before the job queue existed have no jobs """
+        job = self.latest_job()
+        return job is None or job.status == JOB_DONE
+
+    def import_failed(self):
+        job = self.latest_job()
+        return job is not None and job.status == JOB_FAILED
 
     def metadata_style(self):
         if self.lat:
@@ -410,8 +1104,10 @@ class OutputFile(db.Model):
         default=datetime.now(timezone("US/Eastern")),
     )
 
+    creator = db.relationship("User", lazy=True)
+
     def created_user(self):
-        return User.query.filter_by(id=self.created_by).first()
+        return self.creator
 
     def fancy_create_date(self):
         return self.created_on.strftime("%b %d %Y %H:%M:%S")
@@ -419,3 +1115,121 @@ class OutputFile(db.Model):
     def hard_code_path(self):
 
         return Path(SUMMARY_FILE_FOLDER) / self.filename()
+
+
+class Job(db.Model):
+    """ Background work that gets picked up by the worker in tmc_app.jobs """
+
+    __tablename__ = 'jobdata'
+
+    uid = db.Column(
+        db.Integer,
+        primary_key=True
+    )
+    kind = db.Column(
+        db.String(20),
+        nullable=False
+    )
+    status = db.Column(
+        db.String(20),
+        nullable=False,
+        index=True,
+        default=JOB_QUEUED
+    )
+    progress = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0
+    )
+    message = db.Column(
+        db.Text,
+        nullable=True
+    )
+    project_id = db.Column(
+        db.Integer,
+        db.ForeignKey("projects.uid"),
+        nullable=False
+    )
+    file_id = db.Column(
+        db.Integer,
+        db.ForeignKey("filedata.uid"),
+        nullable=True
+    )
+    created_by = db.Column(
+        db.Integer,
+        db.ForeignKey("userdata.id"),
+        nullable=False
+    )
+    created_on = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=lambda: datetime.now(timezone("US/Eastern")),
+    )
+    started_on = db.Column(
+        db.DateTime,
+        nullable=True
+    )
+    # Updated whenever a running job reports progress, see requeue_stale_jobs()
+    heartbeat_on = db.Column(
+        db.DateTime,
+        nullable=True
+    )
+    finished_on = db.Column(
+        db.DateTime,
+        nullable=True
+    )
+
+    project = db.relationship("Project", lazy=True)
+
+    def is_pending(self):
+        return self.status in [JOB_QUEUED, JOB_RUNNING]
+
+    def label(self):
+        if self.status == JOB_RUNNING:
+            return f"{self.status} ({self.progress}%)"
+        return self.status
+
+
+class TMCCount(db.Model):
+    """ Long-format storage: one row per count, see STORAGE_BACKEND in config.py """
+
+    __tablename__ = 'countdata'
+    __table_args__ = (
+        db.Index("ix_countdata_project_time", "project_id", "time"),
+        db.Index("ix_countdata_file", "file_id"),
+    )
+
+    uid = db.Column(
+        db.Integer,
+        primary_key=True
+    )
+    project_id = db.Column(
+        db.Integer,
+        db.ForeignKey("projects.uid"),
+        nullable=False
+    )
+    file_id = db.Column(
+        db.Integer,
+        db.ForeignKey("filedata.uid", ondelete="CASCADE"),
+        nullable=False
+    )
+    time = db.Column(
+        db.Time,
+        nullable=False
+    )
+    mode = db.Column(
+        db.String(10),
+        nullable=False
+    )
+    leg = db.Column(
+        db.String(10),
+        nullable=False
+    )
+    movement = db.Column(
+        db.String(20),
+        nullable=False
+    )
+    count = db.Column(
+        db.Integer,
+        nullable=False
+    )
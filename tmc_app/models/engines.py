@@ -0,0 +1,149 @@
+"""Process-wide registry of pooled SQLAlchemy engines."""
+import os
+import time
+from threading import Lock
+
+from flask import current_app, has_app_context
+from sqlalchemy import create_engine
+from sqlalchemy.pool import QueuePool
+
+from tmc_app import db
+from config import Config
+
+
+_engines = {}
+_engines_lock = Lock()
+
+
+class TimedQueuePool(QueuePool):
+    """
+    QueuePool that keeps checkout counters and wait times for monitoring.
+
+    The wait time covers everything between asking the pool for a connection
+    and receiving one, so it includes opening a new connection when the pool
+    is still growing.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stats_lock = Lock()
+        self.stats = {
+            "checkouts": 0,
+            "connects": 0,
+            "wait_total_seconds": 0.0,
+            "wait_max_seconds": 0.0,
+        }
+
+    def _do_get(self):
+        started = time.perf_counter()
+        conn = super()._do_get()
+        waited = time.perf_counter() - started
+
+        with self._stats_lock:
+            self.stats["checkouts"] += 1
+            self.stats["wait_total_seconds"] += waited
+            if waited > self.stats["wait_max_seconds"]:
+                self.stats["wait_max_seconds"] = waited
+
+        return conn
+
+    def _create_connection(self):
+        with self._stats_lock:
+            self.stats["connects"] += 1
+        return super()._create_connection()
+
+
+def current_config() -> dict:
+    """ Use the Flask config when there is one, otherwise fall back to config.Config """
+    if has_app_context():
+        return current_app.config
+    return {key: getattr(Config, key) for key in dir(Config) if key.isupper()}
+
+
+def engine_options(config: dict) -> dict:
+    """
+    Build the create_engine() keyword arguments for the pool settings in config.
+
+    SQLite doesn't use a QueuePool, so no pool options are returned for it.
+    """
+
+    uri = config.get("SQLALCHEMY_DATABASE_URI") or ""
+    if uri.startswith("sqlite"):
+        return {}
+
+    return {
+        "poolclass": TimedQueuePool,
+        "pool_size": config.get("DB_POOL_SIZE"),
+        "max_overflow": config.get("DB_MAX_OVERFLOW"),
+        "pool_recycle": config.get("DB_POOL_RECYCLE"),
+        "pool_timeout": config.get("DB_POOL_TIMEOUT"),
+        "pool_pre_ping": True,
+    }
+
+
+def get_engine(uri: str = None):
+    """
+    Return a shared, pooled engine for uri.
+
+    Inside an app context this is Flask-SQLAlchemy's db.engine whenever the
+    uri matches the app's database. Anything else (other databases, or code
+    running outside of Flask) gets one engine per uri and per process, so
+    forked workers never share sockets with their parent.
+    """
+
+    if has_app_context():
+        app_uri = current_app.config.get("SQLALCHEMY_DATABASE_URI")
+        if uri is None or uri == app_uri:
+            return db.engine
+
+    config = current_config()
+    if uri is None:
+        uri = config.get("SQLALCHEMY_DATABASE_URI")
+
+    pid = os.getpid()
+    key = (pid, uri)
+
+    with _engines_lock:
+        engine = _engines.get(key)
+        if engine is None:
+            # Forget engines inherited from a parent process
+            for stale_key in [k for k in _engines if k[0] != pid]:
+                del _engines[stale_key]
+
+            engine = create_engine(uri, **engine_options(config))
+            _engines[key] = engine
+
+    return engine
+
+
+def pool_stats() -> list:
+    """ Summarize the connection pools used by this process """
+
+    engines = []
+    if has_app_context():
+        engines.append(db.engine)
+
+    pid = os.getpid()
+    with _engines_lock:
+        engines.extend(e for (p, _), e in _engines.items() if p == pid and e not in engines)
+
+    all_stats = []
+    for engine in engines:
+        pool = engine.pool
+        stats = {
+            "pid": pid,
+            "url": repr(engine.url),
+            "status": pool.status(),
+        }
+
+        if isinstance(pool, QueuePool):
+            stats["size"] = pool.size()
+            stats["checked_out"] = pool.checkedout()
+            stats["overflow"] = pool.overflow()
+
+        if isinstance(pool, TimedQueuePool):
+            stats.update(pool.stats)
+
+        all_stats.append(stats)
+
+    return all_stats
@@ -1,19 +1,105 @@
+import csv
+import hashlib
+import json
+import os
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from contextlib import contextmanager
+from datetime import time
+from io import StringIO
 from os import environ
+from threading import Lock
 from pathlib import Path
-from datetime import time
-from sqlalchemy import create_engine
 from dotenv import load_dotenv, find_dotenv
+from sqlalchemy import inspect, text
+
+from tmc_app.models.engines import get_engine, current_config
 
 load_dotenv(find_dotenv())
 SQLALCHEMY_DATABASE_URI = environ.get("SQLALCHEMY_DATABASE_URI")
 
 
-def flatten_headers(input_file: Path,
-                    tabname: str) -> list:
+LIGHT_VEHICLES_TAB = "Light Vehicles"
+HEAVY_VEHICLES_TAB = "Heavy Vehicles"
+INFORMATION_TAB = "Information"
+
+# Long-format storage, see TMCCount
+COUNTS_TABLE = "countdata"
+
+# Parsed copies of the raw files live in {project folder}/.parquet/{sha256}.parquet
+# Bump SNAPSHOT_VERSION whenever read_workbook() changes what it returns
+SNAPSHOT_FOLDER = ".parquet"
+SNAPSHOT_VERSION = "1"
+
+# Per-project rollups, see refresh_rollups()
+ROLLUP_TABLES = {
+    "hourly": "rollup_hourly_p{project_id}",
+    "peak": "rollup_peak_p{project_id}",
+    "daily": "rollup_daily_p{project_id}",
+}
+
+# Peak hours are found separately before and after noon, using vehicles only
+PEAK_PERIODS = {
+    "am": (0, 12 * 60),
+    "pm": (12 * 60, 24 * 60),
+}
+VEHICLE_MODES = ["light", "heavy"]
+
+# 'H:MM', 'HH:MM:SS' or a full 'YYYY-MM-DD HH:MM:SS' timestamp
+TIME_PATTERN = r"^(?:\d{4}-\d{2}-\d{2}[ T])?(\d{1,2}):(\d{2})(?::(\d{2})(?:\.\d+)?)?$"
+
+
+class TMCFormatError(ValueError):
+    """Raised when a TMC workbook doesn't look the way we expect."""
+
+
+def normalize_time_column(times: pd.Series, source: str = "") -> pd.Series:
+    """
+    Turn a column of mixed time values into datetime.time objects in one pass.
+
+    Cells can be datetime.time/datetime.datetime objects, 'H:MM' or
+    'HH:MM:SS' strings, or Excel day fractions (0.3125 is 7:30),
+    including ones on a date serial (44348.3125 is also 7:30).
+    Anything else raises a TMCFormatError naming the source file,
+    before any of the file's data is written anywhere.
+    """
+
+    # Every supported cell type has a string form that TIME_PATTERN understands,
+    # except for the Excel fractions, which get converted numerically below
+    parts = times.astype(str).str.strip().str.extract(TIME_PATTERN).astype(float)
+    seconds = parts[0] * 3600 + parts[1] * 60 + parts[2].fillna(0)
+
+    fractions = pd.to_numeric(times.where(parts[0].isna()), errors="coerce")
+
+    # A bare number is a day fraction, or a date serial with the time after the point.
+    # Whole numbers like 5 or 12 aren't times, so they're left as bad values
+    fractions = fractions.where(
+        ((fractions >= 0) & (fractions < 1)) | ((fractions >= 1) & (fractions % 1 != 0))
+    )
+    seconds = seconds.fillna((fractions % 1 * 86400).round())
+
+    bad_values = seconds.isna() | (parts[1] >= 60) | (seconds >= 86400)
+    if bad_values.any():
+        examples = ", ".join(repr(v) for v in times[bad_values].unique()[:5])
+        msg = f"{source}: {bad_values.sum()} value(s) in the time column can't be read as a time, e.g. {examples}"
+        raise TMCFormatError(msg)
+
+    return pd.Series(
+        pd.to_datetime(seconds, unit="s").dt.time.values,
+        index=times.index,
+        name=times.name,
+    )
+
+
+def header_row_names(df_header: pd.DataFrame) -> list:
     """
     Transform a multi-level header into a single header row.
 
+    df_header is the top of a sheet read with header=None,
+    where rows 1 and 2 hold the two header levels.
+
     For example:
         - 'Southbound / U Turns' becomes 'SB U'
         - 'Eastbound / Straight Through' becomes 'EB Thru'
@@ -40,19 +126,14 @@ def flatten_headers(input_file: Path,
         "peds in croswalk": "Peds Xwalk",
     }
 
-    df = pd.read_excel(input_file,
-                       nrows=3,
-                       header=None,
-                       sheet_name=tabname)
-
     headers = []
 
     # Start off with a blank l1
     l1 = ""
 
-    for col in df.columns:
-        level_1 = df.at[1, col]
-        level_2 = df.at[2, col]
+    for col in df_header.columns:
+        level_1 = df_header.at[1, col]
+        level_2 = df_header.at[2, col]
 
         # Update the l1 anytime a value is found
         if not pd.isna(level_1):
@@ -77,6 +158,448 @@ def flatten_headers(input_file: Path,
     return headers
 
 
+def flatten_headers(input_file: Path,
+                    tabname: str) -> list:
+    """
+    Read the first three rows of tabname and flatten them with header_row_names()
+    """
+
+    df = pd.read_excel(input_file,
+                       nrows=3,
+                       header=None,
+                       sheet_name=tabname)
+
+    return header_row_names(df)
+
+
+def parse_metadata(df_info: pd.DataFrame) -> dict:
+    """
+    Pull the location, legs, date and start/end times out of the "Information" tab.
+
+    df_info is the whole tab, read with header=None. The place details
+    live in columns A:B and the time details live in columns D:E.
+    """
+
+    df_info = df_info.reindex(columns=range(5))
+
+    df_location = df_info[[0, 1]].dropna()
+    df_location.columns = ["place_type", "place_name"]
+
+    df_time = df_info[[3, 4]].dropna()
+    df_time.columns = ["time_type", "time_value"]
+
+    data_date = None
+    start_time = ""
+    end_time = ""
+    location_name = ""
+    legs = {}
+
+    # Get the location_name and leg names
+    for _, row in df_location.iterrows():
+
+        if row.place_type == "Intersection Name":
+            location_name = row.place_name
+        else:
+            legs[row.place_type.lower()] = row.place_name
+
+    # Get the date and start/end times
+    for _, row in df_time.iterrows():
+
+        if row.time_type == "Date":
+            data_date = row.time_value
+        elif row.time_type == "Start Time":
+            start_time = row.time_value
+        elif row.time_type == "End Time":
+            end_time = row.time_value
+
+    return {
+        "title": location_name,
+        "legs": legs,
+        "data_date": data_date,
+        "start_time": start_time,
+        "end_time": end_time,
+    }
+
+
+def psql_insert_copy(table, conn, keys, data_iter):
+    """
+    DataFrame.to_sql() method that loads rows with COPY FROM STDIN.
+
+    The rows are written into an in-memory CSV buffer first.
+    This is the recipe from the pandas docs.
+    """
+
+    dbapi_conn = conn.connection
+    with dbapi_conn.cursor() as cur:
+        buffer = StringIO()
+        csv.writer(buffer).writerows(data_iter)
+        buffer.seek(0)
+
+        columns = ", ".join(f'"{k}"' for k in keys)
+        if table.schema:
+            table_name = f"{table.schema}.{table.name}"
+        else:
+            table_name = table.name
+
+        cur.copy_expert(f"COPY {table_name} ({columns}) FROM STDIN WITH CSV", buffer)
+
+
+def write_frame(df: pd.DataFrame,
+                table_name: str,
+                con,
+                **kwargs):
+    """
+    DataFrame.to_sql(), using COPY on Postgres when BULK_INSERT_METHOD is 'copy'
+    """
+
+    use_copy = current_config().get("BULK_INSERT_METHOD") == "copy"
+
+    if use_copy and con.dialect.name == "postgresql":
+        kwargs["method"] = psql_insert_copy
+
+    df.to_sql(table_name, con, **kwargs)
+
+
+def split_column_name(col: str) -> list:
+    """
+    Split a count column into [mode, leg, movement].
+
+    For example, 'light_sb_left' becomes ['light', 'sb', 'left']
+    """
+
+    parts = col.split("_", 2)
+    return parts + [""] * (3 - len(parts))
+
+
+def tidy_counts(df: pd.DataFrame,
+                project_id: int,
+                file_id: int) -> pd.DataFrame:
+    """
+    Reshape a spliced light & heavy frame into one row per count.
+
+    The column names are only parsed once. The values are flattened
+    row by row, so the times repeat and the column parts tile.
+    """
+
+    df_counts = df.drop(columns=["fid"], errors="ignore")
+    n_rows, n_cols = df_counts.shape
+
+    modes, legs, movements = zip(*[split_column_name(col) for col in df_counts.columns])
+
+    df_long = pd.DataFrame({
+        "project_id": int(project_id),
+        "file_id": int(file_id),
+        "time": np.repeat(df_counts.index.values, n_cols),
+        "mode": np.tile(modes, n_rows),
+        "leg": np.tile(legs, n_rows),
+        "movement": np.tile(movements, n_rows),
+        "count": df_counts.to_numpy(dtype=float).ravel(),
+    })
+
+    df_long = df_long.dropna(subset=["count"])
+    df_long["count"] = df_long["count"].astype("int64")
+
+    return df_long
+
+
+# Guards merges between threads of one process, see _locked_project_tables()
+_merge_lock = Lock()
+
+
+@contextmanager
+def _locked_project_tables(engine, project_id: int):
+    """
+    A transaction that has the project's merged and rollup tables to itself.
+
+    Postgres serializes it across processes with an advisory lock on the project,
+    which is released when the transaction ends, so imports into different
+    projects still run side by side. Other databases fall back on _merge_lock,
+    which only covers this process.
+    """
+
+    if engine.dialect.name == "postgresql":
+        with engine.begin() as conn:
+            conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": int(project_id)})
+            yield conn
+    else:
+        with _merge_lock, engine.begin() as conn:
+            yield conn
+
+
+def merge_into_project_table(engine,
+                             project_id: int,
+                             file_id: int):
+    """
+    Copy one file's table into data_merged_p{project_id}, all inside the database.
+
+    Any rows already there for this file are replaced, so re-imports are safe.
+    The merged table is created on first use, and any columns that the
+    file has but the merged table doesn't (i.e. new legs) are added.
+    """
+
+    merged_table = f"data_merged_p{project_id}"
+    file_table = f"data_p{project_id}_f{file_id}"
+
+    with _locked_project_tables(engine, project_id) as conn:
+
+        if not conn.dialect.has_table(conn, merged_table):
+            conn.execute(text(f"CREATE TABLE {merged_table} AS SELECT * FROM {file_table} WHERE 1 = 0"))
+            conn.execute(text(f"CREATE INDEX ix_{merged_table}_time ON {merged_table} (time)"))
+            conn.execute(text(f"CREATE INDEX ix_{merged_table}_fid ON {merged_table} (fid)"))
+
+        inspector = inspect(conn)
+        merged_cols = {col["name"] for col in inspector.get_columns(merged_table)}
+        file_cols = inspector.get_columns(file_table)
+
+        for col in file_cols:
+            if col["name"] not in merged_cols:
+                col_type = col["type"].compile(dialect=conn.dialect)
+                conn.execute(text(f'ALTER TABLE {merged_table} ADD COLUMN "{col["name"]}" {col_type}'))
+
+        col_list = ", ".join(f'"{col["name"]}"' for col in file_cols)
+
+        conn.execute(text(f"DELETE FROM {merged_table} WHERE fid = :fid"), {"fid": int(file_id)})
+        conn.execute(text(f"INSERT INTO {merged_table} ({col_list}) SELECT {col_list} FROM {file_table}"))
+
+
+def remove_from_project_table(engine,
+                              project_id: int,
+                              file_id: int):
+    """ Delete a file's rows from the merged table, countdata and the rollups, and drop the file's own table """
+
+    merged_table = f"data_merged_p{project_id}"
+
+    with _locked_project_tables(engine, project_id) as conn:
+
+        if conn.dialect.has_table(conn, merged_table):
+            conn.execute(text(f"DELETE FROM {merged_table} WHERE fid = :fid"), {"fid": int(file_id)})
+
+        conn.execute(text(f"DELETE FROM {COUNTS_TABLE} WHERE file_id = :fid"), {"fid": int(file_id)})
+
+        for rollup_table in ROLLUP_TABLES.values():
+            rollup_table = rollup_table.format(project_id=project_id)
+            if conn.dialect.has_table(conn, rollup_table):
+                conn.execute(text(f"DELETE FROM {rollup_table} WHERE fid = :fid"), {"fid": int(file_id)})
+
+        conn.execute(text(f"DROP TABLE IF EXISTS data_p{project_id}_f{file_id}"))
+
+
+def peak_hours(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Find the AM and PM peak hour of a spliced light & heavy frame.
+
+    The peak hour is the four consecutive 15-minute bins with the most
+    light and heavy vehicles. The peak hour factor (PHF) is that volume
+    divided by four times its busiest 15-minute bin.
+
+    Returns one row per period with period, start_time, volume and phf columns.
+    """
+
+    vehicle_cols = [col for col in df.columns if split_column_name(col)[0] in VEHICLE_MODES]
+    volumes = df[vehicle_cols].sum(axis=1, min_count=1)
+
+    # Line the bins up on a full day of 15-minute slots, so gaps
+    # (i.e. between the AM and PM counts) never end up in the same hour
+    minutes = [t.hour * 60 + t.minute for t in volumes.index]
+    volumes = pd.Series(volumes.values, index=minutes).groupby(level=0).sum(min_count=1)
+    volumes = volumes.reindex(range(0, 24 * 60, 15))
+
+    # Rolling windows are labelled by their last bin, so shift them back to the start
+    hour_volume = volumes.rolling(4, min_periods=4).sum().shift(-3)
+    busiest_bin = volumes.rolling(4, min_periods=4).max().shift(-3)
+
+    rows = []
+    for period, (start, end) in PEAK_PERIODS.items():
+        in_period = hour_volume[(hour_volume.index >= start) & (hour_volume.index < end)].dropna()
+        if in_period.empty:
+            continue
+
+        start_minute = in_period.idxmax()
+        volume = in_period[start_minute]
+        peak_bin = busiest_bin[start_minute]
+
+        rows.append({
+            "period": period,
+            "start_time": time(start_minute // 60, start_minute % 60),
+            "volume": int(volume),
+            "phf": round(volume / (4 * peak_bin), 3) if peak_bin else None,
+        })
+
+    return pd.DataFrame(rows, columns=["period", "start_time", "volume", "phf"])
+
+
+def build_rollups(df: pd.DataFrame,
+                  file_id: int) -> dict:
+    """
+    Summarize a spliced light & heavy frame for the rollup tables.
+
+    Returns a dict of dataframes, keyed like ROLLUP_TABLES:
+        - hourly: totals per hour, mode, leg and movement
+        - peak: the AM and PM peak hours, see peak_hours()
+        - daily: totals per mode, leg and movement
+    """
+
+    df_long = tidy_counts(df, 0, file_id).drop(columns=["project_id", "file_id"])
+
+    # There are at most 96 distinct times, so find their hours once and map them back
+    codes, unique_times = pd.factorize(df_long.pop("time"))
+    df_long["hour"] = np.array([t.hour for t in unique_times], dtype="int64")[codes]
+
+    keys = ["mode", "leg", "movement"]
+    hourly = df_long.groupby(["hour"] + keys, as_index=False)["count"].sum()
+    daily = df_long.groupby(keys, as_index=False)["count"].sum()
+
+    rollups = {
+        "hourly": hourly,
+        "peak": peak_hours(df.drop(columns=["fid"], errors="ignore")),
+        "daily": daily,
+    }
+
+    for df_rollup in rollups.values():
+        df_rollup.insert(0, "fid", int(file_id))
+
+    return rollups
+
+
+def refresh_rollups(engine,
+                    project_id: int,
+                    file_id: int,
+                    df: pd.DataFrame):
+    """
+    Replace one file's rows in the project's rollup tables.
+
+    The tables are long-format with a fid column, so they never need new
+    columns when a file with different legs shows up. They're created on first use.
+    """
+
+    rollups = build_rollups(df, file_id)
+
+    with _locked_project_tables(engine, project_id) as conn:
+
+        for kind, df_rollup in rollups.items():
+            table_name = ROLLUP_TABLES[kind].format(project_id=project_id)
+            exists = conn.dialect.has_table(conn, table_name)
+
+            if exists:
+                conn.execute(text(f"DELETE FROM {table_name} WHERE fid = :fid"), {"fid": int(file_id)})
+
+            if df_rollup.empty:
+                continue
+
+            write_frame(df_rollup, table_name, conn, if_exists="append", index=False)
+
+            if not exists:
+                conn.execute(text(f"CREATE INDEX ix_{table_name}_fid ON {table_name} (fid)"))
+
+
+def file_sha256(filepath: Path,
+                chunk_size: int = 1024 * 1024) -> str:
+    """ Hash a file in chunks, so it never has to fit in memory """
+
+    sha = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+
+    return sha.hexdigest()
+
+
+def snapshot_path(folder: Path,
+                  content_hash: str) -> Path:
+    return Path(folder) / SNAPSHOT_FOLDER / f"{content_hash}.parquet"
+
+
+def write_snapshot(df: pd.DataFrame,
+                   metadata: dict,
+                   path: Path):
+    """
+    Save a parsed file, as returned by SQLUpload.read_workbook(), to Parquet.
+
+    The count columns are stored by position, since the light and heavy tabs
+    can share a column name. Their real names and the metadata dict go in
+    the schema's metadata. The fid column is left out, because it belongs
+    to the TMCFile and not to the file's contents.
+    """
+
+    df = df.drop(columns=["fid"], errors="ignore")
+
+    arrays = [pa.array(df.index.values)]
+    arrays += [pa.array(df.iloc[:, i].values) for i in range(df.shape[1])]
+    names = ["time"] + [f"c{i}" for i in range(df.shape[1])]
+
+    table = pa.Table.from_arrays(arrays, names=names).replace_schema_metadata({
+        "tmc_snapshot_version": SNAPSHOT_VERSION,
+        "tmc_columns": json.dumps(list(df.columns)),
+        "tmc_metadata": json.dumps(metadata, default=str),
+    })
+
+    # Write to a temporary file first, so readers never see half a snapshot
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    pq.write_table(table, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def read_snapshot(path: Path,
+                  file_id: int):
+    """
+    Memory-map a snapshot made by write_snapshot().
+
+    Returns (df, metadata) just like SQLUpload.read_workbook(),
+    or None if there's no snapshot or it's out of date.
+    """
+
+    if not path.exists():
+        return None
+
+    table = pq.read_table(path, memory_map=True)
+    schema_metadata = table.schema.metadata or {}
+
+    if schema_metadata.get(b"tmc_snapshot_version") != SNAPSHOT_VERSION.encode():
+        return None
+
+    df = table.to_pandas().set_index("time")
+    df.columns = json.loads(schema_metadata[b"tmc_columns"])
+    df["fid"] = int(file_id)
+
+    metadata = json.loads(schema_metadata[b"tmc_metadata"])
+    if metadata["data_date"]:
+        metadata["data_date"] = pd.to_datetime(metadata["data_date"]).to_pydatetime()
+
+    return df, metadata
+
+
+def parse_tmc_file(project_id: int,
+                   file_id: int,
+                   filepath: Path):
+    """
+    Read one TMC file, returning (df, metadata, content_hash).
+
+    The Parquet snapshot is used when there is one. Otherwise the workbook
+    is parsed and a snapshot is saved for next time.
+
+    This lives at the module level so that it can be sent to a process pool.
+    """
+
+    content_hash = file_sha256(filepath)
+    path = snapshot_path(Path(filepath).parent, content_hash)
+
+    parsed = read_snapshot(path, file_id)
+
+    if parsed is None:
+        parsed = SQLUpload(project_id, file_id, filepath).read_workbook()
+
+        # The snapshot is only a cache, so don't fail the import over it
+        try:
+            write_snapshot(*parsed, path)
+        except Exception as e:
+            print(f"!!! Couldn't save a snapshot of {filepath}: {e}")
+
+    df, metadata = parsed
+
+    return df, metadata, content_hash
+
+
 class SQLUpload:
     """
     Efficiently extract data from Excel and import into SQL.
@@ -91,10 +614,38 @@ class SQLUpload:
         self._pid = project_id
         self._fid = file_id
         self._filepath = filepath
+        self.metadata = None
+
+    def read_workbook(self):
+        """
+        Open the Excel file once and pull everything we need out of it.
+
+        Returns
+        -------
+            - the spliced light & heavy dataframe
+            - the metadata dict from the "Information" tab
+        """
+
+        tabs = [LIGHT_VEHICLES_TAB, HEAVY_VEHICLES_TAB, INFORMATION_TAB]
+
+        with pd.ExcelFile(self._filepath) as workbook:
+            sheets = workbook.parse(sheet_name=tabs, header=None)
+
+        df_light = self.read_data(LIGHT_VEHICLES_TAB, "Light", sheets[LIGHT_VEHICLES_TAB])
+        df_heavy = self.read_data(HEAVY_VEHICLES_TAB, "Heavy", sheets[HEAVY_VEHICLES_TAB])
+
+        df = pd.concat([df_light, df_heavy], axis=1, sort=False)
+
+        df["fid"] = int(self._fid)
+
+        self.metadata = parse_metadata(sheets[INFORMATION_TAB])
+
+        return df, self.metadata
 
     def read_data(self,
                   tabname: str,
-                  col_prefix: str):
+                  col_prefix: str,
+                  df_raw: pd.DataFrame = None):
         """
         Minimalist approach to reading the XLS files.
 
@@ -103,24 +654,23 @@ class SQLUpload:
             - tabname: name of tab in the excel file
             - col_prefix: whatever you want to use at
                           the beginning of the column names.
+            - df_raw: the whole tab, already read with header=None.
+                      If not provided, the tab is read from the file.
         """
 
-        df = pd.read_excel(self._filepath,
-                           skiprows=3,
-                           header=None,
-                           names=flatten_headers(self._filepath, tabname),
-                           sheet_name=tabname).dropna()
+        if df_raw is None:
+            df_raw = pd.read_excel(self._filepath,
+                                   header=None,
+                                   sheet_name=tabname)
 
-        # Check all time values and ensure that each one
-        # is formatted as a datetime.time. Some aren't by default!
-        for idx, row in df.iterrows():
+        # The first three rows hold the headers, everything below is data
+        df = df_raw.iloc[3:].copy()
+        df.columns = header_row_names(df_raw.iloc[:3])
+        df = df.dropna().infer_objects()
 
-            if type(row.time) != time:
-                hour, minute = row.time.split(":")
-                df.at[idx, "time"] = time(
-                    hour=int(hour),
-                    minute=int(minute)
-                )
+        # Ensure that each time value is formatted as a datetime.time.
+        # Some aren't by default!
+        df["time"] = normalize_time_column(df["time"], f"{Path(self._filepath).name} ({tabname})")
 
         # Reindex on the time column
         df.set_index("time", inplace=True)
@@ -150,31 +700,45 @@ class SQLUpload:
 
     def spliced_light_and_heavy_df(self):
 
-        df_light = self.read_data("Light Vehicles", "Light")
-        df_heavy = self.read_data("Heavy Vehicles", "Heavy")
-
-        df = pd.concat([df_light, df_heavy], axis=1, sort=False)
-
-        df["fid"] = int(self._fid)
+        df, _ = self.read_workbook()
 
         return df
 
     def publish_to_database(self,
                             db_uri: str = SQLALCHEMY_DATABASE_URI,
                             df: pd.DataFrame = None,
-                            pg_table_name: str = None,):
+                            pg_table_name: str = None,
+                            engine=None):
 
-        if not df:
-            df = self.spliced_light_and_heavy_df()
+        if df is None:
+            df, _ = self.read_workbook()
         if not pg_table_name:
             pg_table_name = f"data_p{self._pid}_f{self._fid}"
 
-        engine = create_engine(db_uri)
+        if engine is None:
+            engine = get_engine(db_uri)
 
         kwargs = {
             "if_exists": "replace",
         }
 
-        df.to_sql(pg_table_name, engine, **kwargs)
+        write_frame(df, pg_table_name, engine, **kwargs)
+
+    def publish_counts(self,
+                       df: pd.DataFrame = None,
+                       engine=None):
+        """
+        Write this file to the long-format countdata table,
+        replacing anything that was already stored for it.
+        """
+
+        if df is None:
+            df, _ = self.read_workbook()
+        if engine is None:
+            engine = get_engine()
+
+        df_long = tidy_counts(df, self._pid, self._fid)
 
-        engine.dispose()
+        with engine.begin() as conn:
+            conn.execute(text(f"DELETE FROM {COUNTS_TABLE} WHERE file_id = :fid"), {"fid": int(self._fid)})
+            write_frame(df_long, COUNTS_TABLE, conn, if_exists="append", index=False)
@@ -1,5 +1,5 @@
 """Logged-in page routes."""
-from flask import Blueprint, render_template, redirect, url_for, flash
+from flask import Blueprint, render_template, redirect, url_for, flash, jsonify
 from flask_login import current_user, login_required
 
 from tmc_app import make_random_gradient, db
@@ -10,6 +10,7 @@ from tmc_app.models import (
     TMCFile
 )
 
+from tmc_app.models.engines import pool_stats
 from tmc_app.forms import AddProjectForm, SaveRainbowForm
 
 # Blueprint Configuration
@@ -40,7 +41,8 @@ def dashboard():
         make_random_gradient=make_random_gradient,
         form=form,
         your_projects=your_projects,
-        other_projects=other_projects
+        other_projects=other_projects,
+        file_counts=Project.file_counts()
     )
 
 
@@ -123,3 +125,11 @@ def save_rainbow():
 
         return redirect(url_for('project_bp.single_project',
                                 project_id=project.uid))
+
+
+@main_bp.route('/status/db-pool', methods=['GET'])
+@login_required
+def db_pool_status():
+    """Connection pool statistics for this worker process"""
+
+    return jsonify(pool_stats())
@@ -1,6 +1,7 @@
 from pathlib import Path
-from flask import Blueprint, redirect, url_for, flash, request, send_file
+from flask import Blueprint, redirect, url_for, flash, request, send_file, Response, stream_with_context
 from flask_login import login_required
+import hashlib
 import zipfile
 from os import environ
 from tmc_app import db
@@ -17,6 +18,11 @@ load_dotenv(find_dotenv())
 SUMMARY_FILE_FOLDER = environ.get("SUMMARY_FILE_FOLDER")
 RAW_DATA_FOLDER = environ.get("RAW_DATA_FOLDER")
 
+ZIP_CHUNK_SIZE = 1024 * 1024
+
+# These are compressed already, so deflating them again only costs CPU
+PRECOMPRESSED_SUFFIXES = [".xlsx", ".xlsm", ".zip"]
+
 
 # Blueprint Configuration
 download_bp = Blueprint(
@@ -26,6 +32,85 @@ download_bp = Blueprint(
 )
 
 
+class _ZipStream:
+    """
+    A write-only file for zipfile that hands back whatever was written to it.
+
+    It has no tell() or seek(), so zipfile treats it as a stream
+    and writes each member's sizes after its data.
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def stream_zip(files: list):
+    """
+    Yield a zip archive of (path, name in the archive) pairs, piece by piece.
+
+    Nothing is written to disk and only about one chunk
+    of the archive is in memory at any time.
+    """
+
+    stream = _ZipStream()
+
+    with zipfile.ZipFile(stream, "w") as archive:
+        for path, arcname in files:
+            info = zipfile.ZipInfo.from_file(path, arcname)
+            if path.suffix.lower() in PRECOMPRESSED_SUFFIXES:
+                info.compress_type = zipfile.ZIP_STORED
+            else:
+                info.compress_type = zipfile.ZIP_DEFLATED
+
+            with open(path, "rb") as src, archive.open(info, "w") as dest:
+                for chunk in iter(lambda: src.read(ZIP_CHUNK_SIZE), b""):
+                    dest.write(chunk)
+                    yield stream.take()
+
+            yield stream.take()
+
+    yield stream.take()
+
+
+def zip_response(files: list, download_name: str):
+    """
+    Stream a zip of files, with an ETag built from their names, sizes and modified times.
+
+    A matching If-None-Match gets a 304 without reading any of the files.
+    """
+
+    files = [(path, arcname) for path, arcname in files if path.exists()]
+
+    fingerprint = hashlib.sha1()
+    for path, arcname in files:
+        stat = path.stat()
+        fingerprint.update(f"{arcname}|{stat.st_size}|{stat.st_mtime_ns}\n".encode("utf-8"))
+    etag = fingerprint.hexdigest()
+
+    if etag in request.if_none_match:
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    response = Response(stream_with_context(stream_zip(files)), mimetype="application/zip")
+    response.headers["Content-Disposition"] = f'attachment; filename="{download_name}"'
+    response.set_etag(etag)
+
+    return response
+
+
 @download_bp.route('/download/output/<outputfile_id>', methods=['GET'])
 @login_required
 def download_output(outputfile_id):
@@ -36,7 +121,8 @@ def download_output(outputfile_id):
 
     file_to_send = Path(SUMMARY_FILE_FOLDER) / output_file.filename
 
-    return send_file(file_to_send, as_attachment=True)
+    # conditional=True answers If-None-Match and Range requests
+    return send_file(file_to_send, as_attachment=True, conditional=True)
 
 
 
@@ -47,11 +133,34 @@ def download_tmc(tmc_id):
     tmc_file = TMCFile.query.filter_by(
         uid=tmc_id
     ).first()
-    
+
+    return send_file(tmc_file.filepath(), as_attachment=True, conditional=True)
+
+
+@download_bp.route('/download/project/<project_id>/raw', methods=['GET'])
+@login_required
+def download_project_raw(project_id):
+
+    project = Project.query.filter_by(
+        uid=project_id
+    ).first()
+
+    files = [(f.filepath(), f.filename) for f in sorted(project.files, key=lambda f: f.filename)]
+
+    return zip_response(files, f"{project.safe_folder_name()}_raw_data.zip")
+
+
+@download_bp.route('/download/project/<project_id>/outputs', methods=['GET'])
+@login_required
+def download_project_outputs(project_id):
+
     project = Project.query.filter_by(
-        uid=tmc_file.project_id
+        uid=project_id
     ).first()
 
-    file_to_send = Path(RAW_DATA_FOLDER) / project.safe_folder_name() / tmc_file.name
+    files = [
+        (Path(SUMMARY_FILE_FOLDER) / f.filename, f.filename)
+        for f in sorted(project.output_files, key=lambda f: f.filename)
+    ]
 
-    return send_file(file_to_send, as_attachment=True)
+    return zip_response(files, f"{project.safe_folder_name()}_outputs.zip")
@@ -3,22 +3,43 @@ from os import environ
 from dotenv import load_dotenv, find_dotenv
 
 # Flask stuff
-from flask import Blueprint, render_template, redirect, url_for, flash, request
+from flask import Blueprint, current_app, render_template, redirect, url_for, flash, request, jsonify
 from flask_login import current_user, login_required
+from flask_wtf.csrf import validate_csrf
+from wtforms import ValidationError
 from werkzeug.utils import secure_filename
+from sqlalchemy.orm import joinedload, selectinload
 
 # General helpers
 from pathlib import Path
+from collections import defaultdict
+from datetime import time
 
-# Plotting
 import json
-import plotly
-import plotly.graph_objects as go
 
 # Project imports
 from tmc_app import make_random_gradient, db
-from tmc_app.models.upload_model import SQLUpload
-from tmc_app.models import Project, TMCFile, OutputFile
+from tmc_app.jobs import enqueue_summary
+from tmc_app.uploads import (
+    append_stream,
+    BAD_ZIP_ERRORS,
+    finish_upload,
+    TMC_EXTENSIONS,
+    UploadError,
+    partial_path,
+    register_upload,
+    save_stream,
+    staging_path,
+    UPLOAD_EXTENSIONS,
+    UPLOAD_ID_PATTERN,
+    UPLOAD_NEW,
+    UPLOAD_REPLACED,
+    UPLOAD_RETRIED,
+    UPLOAD_UNCHANGED,
+    UPLOAD_DUPLICATE,
+)
+from tmc_app.cache import invalidate_project
+from tmc_app.models import Project, TMCFile, OutputFile, Job, JOB_QUEUED, JOB_RUNNING
 
 
 from tmc_app.forms.upload_forms import UploadFilesForm
@@ -41,47 +62,64 @@ project_bp = Blueprint(
 @project_bp.route('/project/<project_id>', methods=['GET'])
 @login_required
 def single_project(project_id):
+    # plotly is only needed for the overview chart, so it isn't loaded when the app starts
+    import plotly
+    import plotly.graph_objects as go
+    from tmc_app.data_viz.get_data import TIME_AXIS, binary_trace, time_axis_values
 
+    # Load the files with their uploaders and jobs up front,
+    # so the page doesn't need a query per file
     project = Project.query.filter_by(
         uid=project_id
+    ).options(
+        selectinload(Project.files).joinedload(TMCFile.uploader),
+        selectinload(Project.files).selectinload(TMCFile.jobs),
     ).first()
 
-    files = TMCFile.query.filter_by(
-        project_id=project_id
-    ).order_by(TMCFile.filename).all()
+    files = sorted(project.files, key=lambda f: f.filename)
 
     summary_files = OutputFile.query.filter_by(
         project_id=project_id
+    ).options(
+        joinedload(OutputFile.creator)
     ).order_by(OutputFile.created_on.desc()).all()
 
     form = UploadFilesForm()
 
-    if len(project.files) == 0:
+    ready_files = project.ready_files()
+
+    if len(ready_files) == 0:
         data = [
             go.Bar(
                 name="Placeholder data",
-                x=[6,7,8,9,10,11,12,13,14,15,16,17,18,19,20],
+                x=time_axis_values([time(h) for h in range(6, 21)]),
                 y=[10,12,15,14,13,11,9,4,7,8,12,14,18,17,16])
         ]
         plot_title = "No data yet! Upload TMC files and this graph will refresh itself."
 
     else:
-        plot_title = f"{project.name}: data from {len(project.files)} files"
-        # Get the full timeseries dataset for this project
-        df_timeseries = project.generate_timeseries_data().sort_index()
+        plot_title = f"{project.name}: data from {len(ready_files)} files"
+
+        # The chart covers 5:00 to 20:00, which is 60 15-minute bars per location.
+        # Roll up to hours once that's more bars than the browser handles well.
+        hourly = len(ready_files) * 60 > current_app.config["OVERVIEW_MAX_POINTS"]
+        if hourly:
+            plot_title += " (hourly totals)"
+
+        # Totals per location and time bin are summed in SQL
+        df_totals = project.generate_location_totals(hourly=hourly)
 
-        # Add a sum column for each row
-        df_timeseries["total_15_min"] = df_timeseries.iloc[:, 1:].sum(axis=1)
-        
         # Make a bar plot of the counts in this project
         # This is a stacked bar graph, so we're making a list of go.Bar() objects
         # This gets turned into JSON, and styled  JS directly in the HTML tempalte
-        data = []
-        for location in df_timeseries.location.unique():
-            filtered_df = df_timeseries[df_timeseries.location == location]
-            data.append(go.Bar(name=location, x=filtered_df.index, y=filtered_df["total_15_min"]))
+        data = [
+            go.Bar(name=location, x=time_axis_values(group["time"]), y=group["total"])
+            for location, group in df_totals.groupby("location", sort=False)
+        ]
 
-    graphJSON = json.dumps(data, cls=plotly.utils.PlotlyJSONEncoder)
+    # The counts go out as base64 typed arrays, which is much smaller than a list of numbers
+    graphJSON = json.dumps([binary_trace(trace.to_plotly_json()) for trace in data],
+                           cls=plotly.utils.PlotlyJSONEncoder)
 
     # Get lat lngs if they exist
     latlng_data = [[f.lat, f.lng, f.name()] for f in project.files if f.lat]
@@ -95,6 +133,7 @@ def single_project(project_id):
         summary_files=summary_files,
         fig=graphJSON,
         graph_title=plot_title,
+        time_axis=json.dumps(TIME_AXIS),
         latlngs=json.dumps(latlng_data)
     )
 
@@ -120,41 +159,27 @@ def upload_file(project_id):
         # Upload files if the user provided any
         if file_list[0].filename != '':
 
-            # Save each file to the app's upload folder
+            # Save each file to the app's upload folder, hashing it on the way,
+            # and queue up anything new for the worker process to import into SQL
+            results = defaultdict(list)
             for f in file_list:
-                filepath = data_path / secure_filename(f.filename)
-                f.save(filepath)
-                print("Saved", filepath)
-
-                tmc_file = TMCFile(
-                    filename=f.filename,
-                    project_id=project_id,
-                    uploaded_by=current_user.id
-                )
-                db.session.add(tmc_file)
-                db.session.commit()
-
-                # Import the data into SQL
-                tmc_uploader = SQLUpload(project_id, tmc_file.uid, filepath)
-                tmc_uploader.publish_to_database()
-
-                # Extract the metadata from the Excel file
-                metadata = tmc_file.extract_metadata()
+                # The worker finds the file again via TMCFile.filepath(),
+                # so store the name it was actually saved under
+                filename = secure_filename(f.filename)
 
-                tmc_file.title = metadata["title"]
-                tmc_file.legs = str(metadata["legs"])
-                tmc_file.data_date = metadata["data_date"]
-                tmc_file.start_time = metadata["start_time"]
-                tmc_file.end_time = metadata["end_time"]
+                if not filename.lower().endswith(TMC_EXTENSIONS):
+                    flash(f"Skipped {f.filename}, which isn't an Excel workbook", "danger")
+                    continue
+                staged = staging_path(data_path, filename)
+                content_hash = save_stream(f.stream, staged)
 
-                db.session.commit()
+                status, _ = register_upload(project, filename, staged, content_hash, current_user.id)
+                results[status].append(filename)
+                print("Saved", filename, f"({status})")
 
-            flash(f"Saved {len(file_list)} files to server", "success")
+            db.session.commit()
 
-
-            # After importing all files, recreate the project table
-            project.create_project_table()
-            flash(f"Updated project-wide SQL table with new files", "info")
+            flash_upload_results(results)
 
     else:
         for error in form.files.errors:
@@ -163,6 +188,133 @@ def upload_file(project_id):
     return redirect(url_for('project_bp.single_project', project_id=project_id))
 
 
+@project_bp.route('/project/<project_id>/upload-chunk', methods=['GET', 'POST'])
+@login_required
+def upload_chunk(project_id):
+    """
+    Chunked, resumable uploads, used by the project page's uploader.
+
+    GET ?upload_id=... says how many bytes of that upload the server has,
+    so an interrupted upload can pick up where it stopped.
+
+    POST ?upload_id=...&filename=...&offset=...&total=... sends the next
+    piece as the raw request body. It's streamed from request.stream straight
+    to disk, so memory use doesn't grow with the file. Once the last piece is
+    in, the file (or every workbook in a zip) goes through register_upload().
+    """
+
+    project = Project.query.filter_by(uid=project_id).first()
+
+    upload_id = request.args.get("upload_id", "")
+    if not UPLOAD_ID_PATTERN.fullmatch(upload_id):
+        return jsonify(error="Missing or invalid upload_id"), 400
+
+    # Keep everyone's partial uploads apart
+    partial = partial_path(project, f"{current_user.id}-{upload_id}")
+    received = partial.stat().st_size if partial.exists() else 0
+
+    if request.method == "GET":
+        return jsonify(received=received)
+
+    try:
+        validate_csrf(request.headers.get("X-CSRFToken"))
+    except ValidationError as e:
+        return jsonify(error=str(e)), 400
+
+    filename = secure_filename(request.args.get("filename", ""))
+    offset = request.args.get("offset", type=int)
+    total = request.args.get("total", type=int)
+
+    if not filename or offset is None or total is None:
+        return jsonify(error="filename, offset and total are required"), 400
+
+    if not filename.lower().endswith(UPLOAD_EXTENSIONS):
+        return jsonify(error=f"{filename} isn't an Excel workbook or a zip file"), 400
+
+    # The browser is out of step, so tell it where to carry on from
+    if offset != received:
+        return jsonify(received=received), 409
+
+    received = append_stream(request.stream, partial)
+
+    if received > total:
+        partial.unlink(missing_ok=True)
+        return jsonify(error=f"Received {received} bytes, but expected {total}"), 400
+
+    if received < total:
+        return jsonify(received=received, total=total, done=False)
+
+    try:
+        results = finish_upload(project, filename, partial, current_user.id)
+    except BAD_ZIP_ERRORS as e:
+        db.session.rollback()
+        return jsonify(error=f"{filename} isn't a zip file that can be read: {e}"), 400
+    except UploadError as e:
+        db.session.rollback()
+        return jsonify(error=f"Couldn't add {filename}: {e}"), 400
+
+    db.session.commit()
+
+    flash_upload_results(results)
+
+    return jsonify(received=received, total=total, done=True, results=results)
+
+
+def flash_upload_results(results: dict):
+    """ Tell the user what register_upload() did with each of their files """
+
+    queued = [name for status in [UPLOAD_NEW, UPLOAD_REPLACED, UPLOAD_RETRIED] for name in results.get(status, [])]
+    if queued:
+        flash(f"Saved {len(queued)} files to server. They will be imported in the background.", "success")
+
+    skipped = [name for status in [UPLOAD_UNCHANGED, UPLOAD_DUPLICATE] for name in results.get(status, [])]
+    if skipped:
+        flash(f"Skipped {len(skipped)} files that are already in this project: {', '.join(skipped)}", "info")
+
+
+@project_bp.route('/project/<project_id>/jobs', methods=['GET'])
+@login_required
+def job_status(project_id):
+    """ Import status for each file, plus any running summary, polled by the project page """
+
+    files = TMCFile.query.filter_by(
+        project_id=project_id
+    ).options(
+        selectinload(TMCFile.jobs)
+    ).all()
+
+    statuses = []
+    for f in files:
+        job = f.latest_job()
+        if job:
+            statuses.append({
+                "file_id": f.uid,
+                "status": job.status,
+                "progress": job.progress,
+                "label": job.label(),
+                "message": job.message,
+            })
+
+    # Project-wide jobs, i.e. summaries
+    project_jobs = Job.query.filter(
+        Job.project_id == project_id,
+        Job.file_id.is_(None),
+        Job.status.in_([JOB_QUEUED, JOB_RUNNING])
+    ).all()
+
+    for job in project_jobs:
+        statuses.append({
+            "file_id": None,
+            "kind": job.kind,
+            "status": job.status,
+            "progress": job.progress,
+            "label": job.label(),
+            "message": job.message,
+        })
+
+    return jsonify(statuses)
+
+
 @project_bp.route('/project/<project_id>/delete/<file_id>', methods=['GET'])
 @login_required
 def delete_file(project_id, file_id):
@@ -170,12 +322,17 @@ def delete_file(project_id, file_id):
     project = Project.query.filter_by(uid=project_id).first()
     tmc_file = TMCFile.query.filter_by(uid=file_id).first()
 
-    filepath = Path("data") / project.safe_folder_name() / tmc_file.filename
-    filepath.unlink()
+    tmc_file.filepath().unlink(missing_ok=True)
+    tmc_file.delete_snapshot()
+
+    # Take the file's rows out of the project-wide table
+    project.remove_file_from_project_table(tmc_file.uid)
 
     db.session.delete(tmc_file)
     db.session.commit()
 
+    invalidate_project(project.uid)
+
     flash(f"Deleted {tmc_file.name() }", "warning")
 
     return redirect(url_for('project_bp.single_project', project_id=project_id))
@@ -187,34 +344,18 @@ def summarize_files(project_id):
 
     project = Project.query.filter_by(uid=project_id).first()
 
-    src_data_path = Path("data") / project.safe_folder_name()
+    # The worker builds the files, see tmc_app.summary
+    pending = Job.query.filter_by(
+        project_id=project.uid,
+        kind="summary"
+    ).filter(Job.status.in_([JOB_QUEUED, JOB_RUNNING])).first()
 
-    # # Execute the analysis code from the pure-python repository
-    # xlsx_path, geojson_path = write_summary_file(
-    #     src_data_path,
-    #     output_folder=Path("data-outputs")
-    # )
-
-    # # Log the two output files in the DB
-    # xlsx = OutputFile(
-    #     filename=str(xlsx_path.name),
-    #     analysis_type="Excel File",
-    #     project_id=project_id,
-    #     created_by=current_user.id
-    # )
-
-    # geojson = OutputFile(
-    #     filename=str(geojson_path.name),
-    #     analysis_type="GeoJSON File",
-    #     project_id=project_id,
-    #     created_by=current_user.id
-    # )
-
-    # db.session.add(xlsx)
-    # db.session.add(geojson)
-    # db.session.commit()
-
-    flash("Summary files are ready for download", "success")
+    if pending:
+        flash("A summary is already being made for this project", "info")
+    else:
+        enqueue_summary(project, current_user.id)
+        db.session.commit()
+        flash("Summarizing the project. The files will show up below when they're ready.", "success")
 
     return redirect(url_for('project_bp.single_project', project_id=project_id))
 
@@ -271,6 +412,9 @@ def update_metadata(project_id, file_id):
 
     db.session.commit()
 
+    # The title is used as the location name in the charts
+    invalidate_project(project_id)
+
     flash(f"Updated metadata for {this_file.name()}", "success")
 
     return redirect(url_for('project_bp.single_project', project_id=project_id))
\ No newline at end of file
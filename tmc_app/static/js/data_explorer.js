@@ -0,0 +1,210 @@
+/*
+ * Clientside callbacks for the Data Explorer, used when DATA_EXPLORER_CLIENTSIDE is on.
+ *
+ * The server sends the selected project's whole day once (see project_payload() in
+ * tmc_app/data_viz/dash_app.py), and the time range, modes and treemap nesting
+ * are applied here, so moving the slider never goes back to the server.
+ *
+ * The payload looks like:
+ *   {
+ *     times: ["05:00", ...],      minutes: [300, ...],
+ *     locations: ["Main St & 1st Ave", ...],
+ *     columns: ["light_n_left", ...],
+ *     time_idx: [...], location_idx: [...],   one entry per row
+ *     values: [[...], ...]                     one count per column, per row
+ *   }
+ */
+
+// plotly.express.colors.qualitative.Dark24
+const DARK24 = [
+    "#2E91E5", "#E15F99", "#1CA71C", "#FB0D0D", "#DA16FF", "#222A2A", "#B68100", "#750D86",
+    "#EB663B", "#511CFB", "#00A08B", "#FB00D1", "#FC0080", "#B2828D", "#6C7C32", "#778AAE",
+    "#862A16", "#A777F1", "#620042", "#1616A7", "#DA60CA", "#6C4516", "#0D2A63", "#AF0038"
+];
+
+function makeNiceTxt(v) {
+    // Turn 5.25 into '5:15', like make_nice_txt() in dash_app.py
+    const hour = Math.floor(v);
+    const minute = Math.round((v - hour) * 60);
+    return `${hour}:${String(minute).padStart(2, "0")}`;
+}
+
+function selectRows(data, selectedRange) {
+    // Indexes of the rows in the time range, which starts inclusive and ends exclusive
+    const start = selectedRange[0] * 60;
+    const end = selectedRange[1] * 60;
+    const rows = [];
+
+    for (let i = 0; i < data.time_idx.length; i++) {
+        const minute = data.minutes[data.time_idx[i]];
+        if (minute >= start && minute < end) {
+            rows.push(i);
+        }
+    }
+    return rows;
+}
+
+function selectColumns(data, modes) {
+    // Indexes of the columns for the selected modes, i.e. 'light' in 'light_n_left'
+    const columns = [];
+
+    data.columns.forEach((name, j) => {
+        if (modes.includes(name.split("_")[0])) {
+            columns.push(j);
+        }
+    });
+    return columns;
+}
+
+function timeseriesFigure(data, rows, columns) {
+    // A stacked bar chart per location, laid out like plotly.express.bar(facet_col="location")
+    const numLocations = data.locations.length;
+
+    let height, cols;
+    if (numLocations % 2 === 1) {
+        height = (numLocations + 1) / 2 * 200;
+        cols = 2;
+    } else {
+        height = numLocations / 2 * 200;
+        cols = 2;
+    }
+    if (height > 1000) {
+        height = 1000;
+        cols = 3;
+    }
+
+    const numRows = Math.ceil(numLocations / cols);
+    const traces = [];
+    const annotations = [];
+
+    data.locations.forEach((location, loc) => {
+        const axis = loc === 0 ? "" : String(loc + 1);
+        const locationRows = rows.filter(i => data.location_idx[i] === loc);
+        const x = locationRows.map(i => data.times[data.time_idx[i]]);
+
+        columns.forEach((j, c) => {
+            traces.push({
+                type: "bar",
+                name: data.columns[j],
+                legendgroup: data.columns[j],
+                showlegend: loc === 0,
+                marker: {color: DARK24[c % DARK24.length]},
+                x: x,
+                y: locationRows.map(i => data.values[i][j]),
+                xaxis: "x" + axis,
+                yaxis: "y" + axis,
+            });
+        });
+
+        annotations.push({
+            text: `location=${location}`,
+            showarrow: false,
+            xref: `x${axis} domain`,
+            yref: `y${axis} domain`,
+            x: 0.5,
+            y: 1.0,
+            xanchor: "center",
+            yanchor: "bottom",
+        });
+    });
+
+    return {
+        data: traces,
+        layout: {
+            height: height,
+            barmode: "relative",
+            grid: {rows: numRows, columns: cols, pattern: "independent", roworder: "top to bottom"},
+            annotations: annotations,
+            legend: {title: {text: "variable"}},
+        },
+    };
+}
+
+function treemapFigure(data, rows, columns, path) {
+    // Sum the selection down to the leaves of path, and every node above them
+    const nodes = new Map();
+
+    function attribute(name, i, j) {
+        switch (name) {
+            case "location": return data.locations[data.location_idx[i]];
+            case "veh_class": return data.columns[j].split("_")[0];
+            case "leg": return data.columns[j].split("_")[1];
+            case "movement": return data.columns[j].split("_")[2];
+            case "hour": return String(parseInt(data.times[data.time_idx[i]].split(":")[0], 10));
+            case "minute": return ":" + data.times[data.time_idx[i]].split(":")[1];
+        }
+    }
+
+    rows.forEach(i => {
+        columns.forEach(j => {
+            const value = data.values[i][j];
+            if (!value) {
+                return;
+            }
+
+            let parent = "";
+            path.forEach(name => {
+                const label = attribute(name, i, j);
+                const id = parent ? `${parent}/${label}` : label;
+
+                const node = nodes.get(id);
+                if (node) {
+                    node.value += value;
+                } else {
+                    nodes.set(id, {label: label, parent: parent, value: value});
+                }
+                parent = id;
+            });
+        });
+    });
+
+    const ids = Array.from(nodes.keys());
+
+    return {
+        data: [{
+            type: "treemap",
+            branchvalues: "total",
+            ids: ids,
+            labels: ids.map(id => nodes.get(id).label),
+            parents: ids.map(id => nodes.get(id).parent),
+            values: ids.map(id => nodes.get(id).value),
+        }],
+        layout: {
+            margin: {l: 20, r: 20, t: 20, b: 20},
+        },
+    };
+}
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    data_explorer: {
+        filter_timeseries: function (data, selectedRange, modes) {
+            if (!data) {
+                throw window.dash_clientside.PreventUpdate;
+            }
+
+            const rows = selectRows(data, selectedRange);
+            if (rows.length === 0) {
+                throw window.dash_clientside.PreventUpdate;
+            }
+
+            return [
+                timeseriesFigure(data, rows, selectColumns(data, modes)),
+                makeNiceTxt(selectedRange[0]),
+                makeNiceTxt(selectedRange[1]),
+            ];
+        },
+
+        filter_treemap: function (data, selectedRange, modes, path) {
+            if (!data || !path || path.length < 1) {
+                throw window.dash_clientside.PreventUpdate;
+            }
+
+            const rows = selectRows(data, selectedRange);
+            if (rows.length === 0) {
+                throw window.dash_clientside.PreventUpdate;
+            }
+
+            return treemapFigure(data, rows, selectColumns(data, modes), path);
+        },
+    },
+});
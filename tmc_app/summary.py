@@ -0,0 +1,202 @@
+"""
+Project summary files.
+
+write_summary_file() builds an Excel workbook and a GeoJSON file for a
+project. It runs on the worker as a "summary" job (see tmc_app.jobs).
+
+Everything is written one file at a time: the workbook is opened in
+xlsxwriter's constant_memory mode, so each row is flushed to disk as soon
+as it's written, and the GeoJSON features are streamed straight to the file.
+The numbers come from the project's rollup tables, or from each file's
+Parquet snapshot when a file isn't in the rollups yet.
+"""
+import json
+from datetime import datetime
+from pathlib import Path
+
+import pandas as pd
+import xlsxwriter
+
+from tmc_app.models.upload_model import build_rollups
+
+
+PEAK_HOURS_HEADER = ["Location", "File", "Date", "Period", "Peak Hour Start", "Volume", "PHF"]
+MODE_SPLIT_HEADER = ["Location", "File", "Light", "Heavy", "Bikes", "Peds", "Total Vehicles", "% Heavy"]
+MOVEMENTS_HEADER = ["Location", "File", "Mode", "Leg", "Movement", "Count"]
+
+
+def _split_by_file(df: pd.DataFrame) -> dict:
+    return {fid: group for fid, group in df.groupby("fid", sort=False)}
+
+
+def _file_rollups(tmc_file, rollups_by_fid):
+    """ (peak, daily) frames for one file """
+
+    if rollups_by_fid is not None:
+        peak, daily = rollups_by_fid
+        return (
+            peak.get(tmc_file.uid, pd.DataFrame(columns=["fid", "period", "start_time", "volume", "phf"])),
+            daily.get(tmc_file.uid, pd.DataFrame(columns=["fid", "mode", "leg", "movement", "count"])),
+        )
+
+    df, _ = tmc_file.read_parsed()
+    rollups = build_rollups(df, tmc_file.uid)
+
+    return rollups["peak"], rollups["daily"]
+
+
+def _phf(value):
+    """ A blank PHF, instead of NaN, when a peak hour had no traffic """
+    if pd.isna(value):
+        return None
+    return float(value)
+
+
+def _date_label(tmc_file):
+    if tmc_file.data_date:
+        return tmc_file.data_date.strftime("%Y-%m-%d")
+    return ""
+
+
+def _geojson_feature(tmc_file, peak, vehicles: int):
+    """ A point for a file that has a lat/lng, or None """
+
+    try:
+        lat = float(tmc_file.lat)
+        lng = float(tmc_file.lng)
+    except (TypeError, ValueError):
+        return None
+
+    properties = {
+        "name": tmc_file.name(),
+        "file": tmc_file.filename,
+        "date": _date_label(tmc_file),
+        "total_vehicles": vehicles,
+    }
+
+    for row in peak.itertuples():
+        properties[f"{row.period}_peak_start"] = row.start_time.strftime("%H:%M")
+        properties[f"{row.period}_peak_volume"] = int(row.volume)
+        properties[f"{row.period}_peak_phf"] = _phf(row.phf)
+
+    return {
+        "type": "Feature",
+        "geometry": {"type": "Point", "coordinates": [lng, lat]},
+        "properties": properties,
+    }
+
+
+def write_summary_file(project,
+                       output_folder: Path,
+                       progress=None):
+    """
+    Summarize every imported file in the project.
+
+    Parameters
+    ----------
+        - project: the Project to summarize
+        - output_folder: where the files are saved
+        - progress: optional callback, called with (files done, total files)
+
+    Returns
+    -------
+        - the path to the Excel file
+        - the path to the GeoJSON file
+    """
+
+    output_folder = Path(output_folder)
+    output_folder.mkdir(parents=True, exist_ok=True)
+
+    stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    xlsx_path = output_folder / f"{project.safe_folder_name()}_summary_{stamp}.xlsx"
+    geojson_path = output_folder / f"{project.safe_folder_name()}_summary_{stamp}.geojson"
+
+    files = sorted(project.ready_files(), key=lambda f: f.name())
+    fids = [f.uid for f in files]
+
+    # The rollups are tiny compared to the 15-minute data, so read them in one go when they cover everything
+    rollups_by_fid = None
+    if fids and project.has_rollups(fids):
+        rollups_by_fid = (
+            _split_by_file(project.peak_hours(fids)),
+            _split_by_file(project.daily_totals(fids)),
+        )
+
+    workbook = xlsxwriter.Workbook(str(xlsx_path), {"constant_memory": True})
+    bold = workbook.add_format({"bold": True})
+    percent = workbook.add_format({"num_format": "0.0%"})
+
+    sheets = {}
+    for name, header in [("Peak Hours", PEAK_HOURS_HEADER),
+                         ("Mode Split", MODE_SPLIT_HEADER),
+                         ("Movements", MOVEMENTS_HEADER)]:
+        sheet = workbook.add_worksheet(name)
+        sheet.write_row(0, 0, header, bold)
+        sheets[name] = [sheet, 1]
+
+    def write_row(sheet_name, values, cell_format=None):
+        sheet, row = sheets[sheet_name]
+        sheet.write_row(row, 0, values, cell_format)
+        sheets[sheet_name][1] += 1
+
+    with open(geojson_path, "w") as geojson:
+        geojson.write('{"type": "FeatureCollection", "features": [\n')
+        num_features = 0
+
+        for i, tmc_file in enumerate(files):
+            peak, daily = _file_rollups(tmc_file, rollups_by_fid)
+            location = tmc_file.name()
+
+            for row in peak.itertuples():
+                write_row("Peak Hours", [
+                    location,
+                    tmc_file.filename,
+                    _date_label(tmc_file),
+                    row.period.upper(),
+                    row.start_time.strftime("%H:%M"),
+                    int(row.volume),
+                    _phf(row.phf),
+                ])
+
+            modes = daily.groupby("mode")["count"].sum()
+            light = int(modes.get("light", 0))
+            heavy = int(modes.get("heavy", 0))
+            vehicles = light + heavy
+
+            write_row("Mode Split", [
+                location,
+                tmc_file.filename,
+                light,
+                heavy,
+                int(modes.get("bikes", 0)),
+                int(modes.get("peds", 0)),
+                vehicles,
+            ])
+            sheet, row_num = sheets["Mode Split"]
+            sheet.write_number(row_num - 1, 7, heavy / vehicles if vehicles else 0, percent)
+
+            for row in daily.itertuples():
+                write_row("Movements", [
+                    location,
+                    tmc_file.filename,
+                    row.mode,
+                    row.leg.upper(),
+                    row.movement,
+                    int(row.count),
+                ])
+
+            feature = _geojson_feature(tmc_file, peak, vehicles)
+            if feature:
+                if num_features:
+                    geojson.write(",\n")
+                json.dump(feature, geojson)
+                num_features += 1
+
+            if progress:
+                progress(i + 1, len(files))
+
+        geojson.write("\n]}\n")
+
+    workbook.close()
+
+    return xlsx_path, geojson_path
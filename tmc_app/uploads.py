@@ -0,0 +1,274 @@
+"""
+Saving uploaded TMC files.
+
+Uploads are copied into the project folder in chunks and hashed along the
+way, so a file never has to sit in memory and its SHA-256 is known as soon
+as it's saved. register_upload() then compares that hash with the files
+already in the project, so re-uploading a folder only imports what changed.
+
+Big uploads come in through the chunked upload endpoint instead, which
+appends each piece to {project folder}/.partial/ until the file is complete.
+Zip archives are unpacked one workbook at a time.
+"""
+import hashlib
+import os
+import re
+import zipfile
+import zlib
+from collections import defaultdict
+from pathlib import Path
+
+from werkzeug.utils import secure_filename
+
+from tmc_app import db
+from tmc_app.jobs import enqueue_ingest
+from tmc_app.models import TMCFile
+
+
+CHUNK_SIZE = 1024 * 1024
+
+PARTIAL_FOLDER = ".partial"
+UPLOAD_ID_PATTERN = re.compile(r"[A-Za-z0-9_-]{1,100}")
+TMC_EXTENSIONS = (".xls", ".xlsx", ".xlsm")
+# The chunked uploader also takes zips of workbooks
+UPLOAD_EXTENSIONS = TMC_EXTENSIONS + (".zip",)
+
+# What register_upload() did with a file
+UPLOAD_NEW = "new"
+UPLOAD_REPLACED = "replaced"
+UPLOAD_RETRIED = "retried"
+UPLOAD_UNCHANGED = "unchanged"
+UPLOAD_DUPLICATE = "duplicate"
+
+# What a corrupt or unsupported zip archive raises while it's read
+BAD_ZIP_ERRORS = (zipfile.BadZipFile, zipfile.LargeZipFile, EOFError, zlib.error)
+
+
+class UploadError(ValueError):
+    """Raised when an upload can't be added to a project, with a message for the user."""
+
+
+def staging_path(folder: Path,
+                 filename: str) -> Path:
+    """ Where an upload is written before register_upload() moves it into place """
+    return Path(folder) / f".{filename}.upload"
+
+
+def save_stream(stream,
+                filepath: Path,
+                chunk_size: int = CHUNK_SIZE) -> str:
+    """ Copy a file-like object to filepath one chunk at a time, returning its SHA-256 """
+
+    sha = hashlib.sha256()
+
+    with open(filepath, "wb") as f:
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            sha.update(chunk)
+            f.write(chunk)
+
+    return sha.hexdigest()
+
+
+def partial_path(project,
+                 upload_id: str) -> Path:
+    """ Where the chunks of an upload are collected, see append_stream() """
+    return project.folder_path() / PARTIAL_FOLDER / upload_id
+
+
+def append_stream(stream,
+                  filepath: Path,
+                  chunk_size: int = CHUNK_SIZE) -> int:
+    """ Add a file-like object to the end of filepath one chunk at a time, returning the new size """
+
+    filepath.parent.mkdir(parents=True, exist_ok=True)
+
+    with open(filepath, "ab") as f:
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            f.write(chunk)
+
+        return f.tell()
+
+
+def register_upload(project,
+                    filename: str,
+                    staged_path: Path,
+                    content_hash: str,
+                    user_id: int):
+    """
+    Add a saved upload to the project, unless the project already has it.
+
+    Returns (status, tmc_file), where status is one of:
+        - UPLOAD_NEW: a new TMCFile was made and queued for import
+        - UPLOAD_REPLACED: a file with this name had different contents,
+          so it was overwritten and its TMCFile is imported again
+        - UPLOAD_RETRIED: the same file failed to import before, so it's queued again
+        - UPLOAD_UNCHANGED: the same file is already there, nothing to do
+        - UPLOAD_DUPLICATE: the same contents are already there under another name
+
+    A file under another name whose import failed isn't a duplicate, since
+    uploading it again under a corrected name is how that gets fixed.
+    Nothing is parsed or written to the database for unchanged files and duplicates.
+    The caller commits.
+    """
+    from tmc_app.models.upload_model import file_sha256
+
+    same_name = next((f for f in project.files if f.filename == filename), None)
+
+    # Files uploaded before uploads were hashed get their hash now
+    if same_name and not same_name.content_hash and same_name.filepath().exists():
+        same_name.content_hash = file_sha256(same_name.filepath())
+
+    same_contents = next((
+        f for f in project.files
+        if f.content_hash == content_hash and (f is same_name or not f.import_failed())
+    ), None)
+
+    if same_contents:
+        staged_path.unlink(missing_ok=True)
+
+        if same_contents is not same_name:
+            return UPLOAD_DUPLICATE, same_contents
+
+        if same_name.import_failed():
+            enqueue_ingest(same_name, user_id)
+            return UPLOAD_RETRIED, same_name
+
+        return UPLOAD_UNCHANGED, same_name
+
+    os.replace(staged_path, project.folder_path() / filename)
+
+    if same_name:
+        same_name.delete_snapshot()
+        same_name.content_hash = content_hash
+        same_name.uploaded_by = user_id
+        enqueue_ingest(same_name, user_id)
+
+        return UPLOAD_REPLACED, same_name
+
+    tmc_file = TMCFile(
+        filename=filename,
+        project_id=project.uid,
+        uploaded_by=user_id,
+        content_hash=content_hash
+    )
+    project.files.append(tmc_file)
+    db.session.flush()
+
+    enqueue_ingest(tmc_file, user_id)
+
+    return UPLOAD_NEW, tmc_file
+
+
+def _is_workbook(member: zipfile.ZipInfo) -> bool:
+    """ Is this zip member a TMC workbook, rather than a folder or a macOS leftover? """
+    name = Path(member.filename).name
+
+    if member.is_dir() or name.startswith(".") or "__MACOSX" in member.filename:
+        return False
+    return name.lower().endswith(TMC_EXTENSIONS)
+
+
+def _member_filenames(members: list) -> list:
+    """
+    The name each workbook in a zip is saved under, in the same order.
+
+    That's normally the workbook's own name, but workbooks that share a name
+    in different folders get their folders folded in, so north/count.xlsx and
+    south/count.xlsx become north_count.xlsx and south_count.xlsx.
+    Names that still clash raise an UploadError.
+    """
+
+    names = [secure_filename(Path(member.filename).name) for member in members]
+    clashing = {name for name in names if names.count(name) > 1}
+
+    names = [
+        secure_filename(member.filename) if name in clashing else name
+        for member, name in zip(members, names)
+    ]
+
+    repeated = sorted({name for name in names if names.count(name) > 1})
+    if repeated:
+        raise UploadError(f"the zip has more than one workbook named {', '.join(repeated)}")
+
+    return names
+
+
+def register_zip(project,
+                 zip_path: Path,
+                 user_id: int):
+    """
+    Register every TMC workbook in a zip archive.
+
+    Members are decompressed straight to their staging files one at a time,
+    so only one chunk of the archive is ever in memory. Every member is
+    staged before any of them is registered, so a corrupt archive raises
+    one of BAD_ZIP_ERRORS without leaving anything behind. See _member_filenames()
+    for what each workbook is saved as.
+    Returns a list of (filename, status). The caller commits.
+    """
+
+    folder = project.folder_path()
+    staged_members = []
+
+    try:
+        with zipfile.ZipFile(zip_path) as archive:
+            members = [member for member in archive.infolist() if _is_workbook(member)]
+
+            for member, filename in zip(members, _member_filenames(members)):
+                staged = staging_path(folder, filename)
+                staged_members.append((filename, staged, None))
+
+                with archive.open(member) as stream:
+                    staged_members[-1] = (filename, staged, save_stream(stream, staged))
+
+    except BAD_ZIP_ERRORS:
+        for _, staged, _ in staged_members:
+            staged.unlink(missing_ok=True)
+        raise
+
+    results = []
+    for filename, staged, content_hash in staged_members:
+        status, _ = register_upload(project, filename, staged, content_hash, user_id)
+        results.append((filename, status))
+
+    return results
+
+
+def finish_upload(project,
+                  filename: str,
+                  filepath: Path,
+                  user_id: int) -> dict:
+    """
+    Register a completely received upload, which may be a zip of workbooks.
+
+    Returns {status: [filenames]}. The caller commits.
+    """
+    from tmc_app.models.upload_model import file_sha256
+
+    results = defaultdict(list)
+
+    if filename.lower().endswith(".zip"):
+        try:
+            for name, status in register_zip(project, filepath, user_id):
+                results[status].append(name)
+        finally:
+            filepath.unlink(missing_ok=True)
+
+    elif not filename.lower().endswith(TMC_EXTENSIONS):
+        filepath.unlink(missing_ok=True)
+        raise UploadError("it isn't an Excel workbook or a zip file")
+
+    else:
+        staged = staging_path(project.folder_path(), filename)
+        os.replace(filepath, staged)
+
+        status, _ = register_upload(project, filename, staged, file_sha256(staged), user_id)
+        results[status].append(filename)
+
+    return results
@@ -0,0 +1,9 @@
+from tmc_app import create_app
+from tmc_app.jobs import run_worker
+
+app = create_app(with_dashboard=False)
+
+if __name__ == "__main__":
+
+    with app.app_context():
+        run_worker()